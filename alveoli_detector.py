@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 import os.path
+import threading
+
+# VirtualFusedVolume objects opened by each thread, see _open_volume
+_volumes = threading.local()
 
 
 def main():
@@ -12,7 +16,7 @@ def main():
     from scipy.spatial.qhull import QhullError
     from scipy import spatial
     spatial.QhullError = QhullError
-    from skimage.transform import resize
+    from multiprocessing import Pool
     from os import getcwd
     from os.path import join
 
@@ -33,16 +37,46 @@ def main():
                         default=2.5)
     parser.add_argument('-o', '--outpath', help="output base path", metavar='PATH')
     parser.add_argument('-n', '--name', help="experiment name without spaces")
+    parser.add_argument('-j', '--jobs', help="number of blocks processed in parallel", type=int, default=1)
+    parser.add_argument('-p', '--prefetch', help="number of blocks read ahead while analyzing, when running serially",
+                        type=int, default=2)
+    parser.add_argument('-c', '--cache', help="directory where block results are cached, to resume interrupted runs",
+                        metavar='PATH')
+    parser.add_argument('-r', '--resampler', help="downscaling of full-res blocks: skimage resize with anti-aliasing, "
+                                                  "or the faster averaging of bin_resize", choices=['resize', 'bin'],
+                        default='resize')
+    parser.add_argument('-s', '--seeds', help="watershed markers of the segmentation: skeleton branches, or the "
+                                              "cheaper h-maxima of the distance transform",
+                        choices=['skeleton', 'distance'], default='skeleton')
+    parser.add_argument('--hmax', help="minimum height (in voxels) of the distance maxima used as markers with "
+                                       "--seeds distance", type=float, default=2)
+    parser.add_argument('-w', '--worklist', help="work list file of the non-empty blocks, written with --plan",
+                        metavar='PATH')
+    parser.add_argument('--plan', help="only write the work list and exit", action='store_true', default=False)
+    parser.add_argument('--shard', help="only analyze shard I of N (1 <= I <= N) of the blocks, for runs spread on "
+                                        "several nodes; results are left in the cache", metavar='I/N')
+    parser.add_argument('--merge', help="write the outputs from the cached results of all blocks, after the shards "
+                                        "are done", action='store_true', default=False)
     args = parser.parse_args()
 
-    logger.info('reading downscaled image...')
+    if args.plan and args.worklist is None:
+        parser.error('--plan requires --worklist')
+    if (args.shard is not None or args.merge) and args.cache is None:
+        parser.error('--shard and --merge require --cache')
+    if args.shard is not None:
+        try:
+            shard, shards = (int(i) for i in args.shard.split('/'))
+        except ValueError:
+            parser.error('--shard must be given as I/N')
+        if not 1 <= shard <= shards:
+            parser.error('--shard I/N requires 1 <= I <= N')
 
-    ds = tiff.imread(args.downscaled)
     thr = 150  # threshold
     msc = 2  # scale from downscale to mask
     dscxy = 16  # xy scale from full-res to downscale
     dscz = 5  # z scale from full-res to downscale
-    ms = mask(ds, thr, msc)
+    sthr = 180  # segmentation threshold
+    segmentation = {'threshold': sthr, 'seeds': args.seeds, 'h': args.hmax}
 
     xred = args.xyscale / (msc * dscxy)
     yred = args.xyscale / (msc * dscxy)
@@ -53,75 +87,319 @@ def main():
     zstep = int(args.blocksize * zred)
 
     vfv = VirtualFusedVolume(args.volume)
+    scale_tup = tuple((args.zscale, args.xyscale, args.xyscale))
+    out_shape = tuple(int(l / r) for l, r in zip(vfv.shape, scale_tup))
+    params = 'blocksize %d xyscale %g zscale %g' % (args.blocksize, args.xyscale, args.zscale)
+
+    if args.worklist is not None and not args.plan:
+        work = read_worklist(args.worklist, params)
+    else:
+        logger.info('reading downscaled image...')
+
+        ds = tiff.imread(args.downscaled)
+        ms = mask(ds, thr, msc)
+
+        # list of non-empty blocks, with their number in the full x/y/z block grid and their foreground voxel count
+        # in the mask as cost estimate
+        work = []
+        n = 1
+        for x in np.arange(0, out_shape[2], args.blocksize):
+            xr = int(x * xred)
+            for y in np.arange(0, out_shape[1], args.blocksize):
+                yr = int(y * yred)
+                for z in np.arange(0, out_shape[0], args.blocksize):
+                    zr = int(z * zred)
+                    cost = np.count_nonzero(ms[zr:(zr + zstep), yr:(yr + ystep), xr:(xr + xstep)])
+                    if cost > 0:
+                        work.append((n, int(x), int(y), int(z), cost))
+                    n += 1
+
+        if args.plan:
+            write_worklist(args.worklist, work, params)
+            logger.info('%d non-empty blocks written to %s', len(work), args.worklist)
+            return
+
+    if args.shard is not None:
+        assigned = shard_blocks([w[4] for w in work], shards)
+        work = [w for w, s in zip(work, assigned) if s == shard - 1]
+        logger.info('shard %d of %d: %d blocks', shard, shards, len(work))
+
+    if args.cache is None:
+        cache = None
+    else:
+        cache = block_cache(args.cache, args.volume, segmentation, args.blocksize, args.xyscale, args.zscale,
+                            args.resampler)
+        logger.info('caching block results in %s', cache)
+
+    tasks = [(args.volume, n, x, y, z, args.blocksize, args.xyscale, args.zscale, segmentation,
+              None if cache is None else join(cache, 'block_%d_%d_%d.npz' % (z, y, x)), args.resampler)
+             for n, x, y, z, c in work]
+    pool = None
+    if args.merge:
+        results = (load_block(t[9]) if os.path.isfile(t[9]) else (None, None, None, 'missing') for t in tasks)
+    elif args.jobs > 1:
+        # blocks are dispatched to a pool of processes, each one with its own VirtualFusedVolume; imap returns the
+        # results in block order, so the output does not depend on the scheduling
+        pool = Pool(args.jobs)
+        results = pool.imap(process_block, tasks)
+    else:
+        # the next blocks are read and downscaled in background threads while the current one is analyzed
+        results = prefetched_blocks(tasks, args.prefetch)
+
+    # results are written to disk as blocks are done: the mask into a memory-mapped tiff, the volumes and surfaces
+    # of the alveoli appended to the csv files. A shard only leaves its results in the cache, the outputs are
+    # assembled by --merge
+    if args.shard is None:
+        base = join(getcwd() if args.outpath == '.' else args.outpath, args.name)
+        out_mask = tiff.memmap(base + '.tiff', shape=out_shape, dtype='uint8')
+        filev = open(base + '_vol.csv', 'w')
+        files = open(base + '_surf.csv', 'w')
+        filea = open(base + '_alveoli.csv', 'w')
+        filea.write('block,x,y,z,volume,surface\n')
+    else:
+        out_mask = None
+
+    total = sum(w[4] for w in work)
+    done = 0
+    for i, ((n, x, y, z, cost), (alveomask, vol, surf, status)) in enumerate(zip(work, results)):
+        done += cost
+        logger.info('processed block %d of %d (%d%% of the foreground)', i + 1, len(work), 100 * done // total)
+        if status == 'segment':
+            logger.error('error while segmenting block %d', n)
+        elif status == 'morpho':
+            logger.error('error while analyzing block %d', n)
+        elif status == 'missing':
+            logger.error('block %d is missing from the cache', n)
+        elif out_mask is not None:
+            np.savetxt(filev, vol, fmt='%d')
+            np.savetxt(files, surf, fmt='%d')
+            np.savetxt(filea, np.column_stack((np.full((len(vol), 4), (n, x, y, z)), vol, surf)), fmt='%d',
+                       delimiter=',')
+            try:
+                zmax = int(np.clip((z + args.blocksize) * args.zscale, 0, vfv.shape[0]))
+                yv2 = int(np.clip((y + args.blocksize) * args.xyscale, 0, vfv.shape[1]))
+                xv2 = int(np.clip((x + args.blocksize) * args.xyscale, 0, vfv.shape[2]))
+                out_mask[z:int(zmax / args.zscale),
+                         y:int(yv2 / args.xyscale), x:int(xv2 / args.xyscale)] = alveomask
+            except ValueError:
+                logger.error('error while analyzing block %d', n)
+            out_mask.flush()
+            for f in (filev, files, filea):
+                f.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if out_mask is not None:
+        del out_mask
+        for f in (filev, files, filea):
+            f.close()
+
+
+def process_block(task):
+    # reads, downscales and analyzes one block. task is (vfv yml path, block number, x, y, z, blocksize, xyscale,
+    # zscale, segment parameters, cache file path or None, resampler), with x, y, z the block origin at analysis
+    # resolution.
+    # Returns the uint8 alveoli mask of the block, volumes and surfaces of its alveoli, and the name of the step that
+    # failed (None if all went well). With a cache file, a block already analyzed is read from it instead
+    return analyze_block(task, *fetch_block(task))
+
+
+def prefetched_blocks(tasks, prefetch):
+    # yields the results of process_block for tasks, in order; up to prefetch blocks following the current one are
+    # read and downscaled by a pool of threads while it is analyzed
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max(prefetch, 1)) as reader:
+        fetched = deque()
+        for task in tasks:
+            fetched.append((task, reader.submit(fetch_block, task)))
+            if len(fetched) > prefetch:
+                task, future = fetched.popleft()
+                yield analyze_block(task, *future.result())
+        while fetched:
+            task, future = fetched.popleft()
+            yield analyze_block(task, *future.result())
+
+
+def fetch_block(task):
+    # first part of process_block: returns the block downscaled to analysis resolution and None, or None and the
+    # result of a block found in the cache
+    import numpy as np
+    from scipy.spatial.qhull import QhullError
+    from scipy import spatial
+    spatial.QhullError = QhullError
+    from skimage.transform import resize
+
+    path, n, x, y, z, blocksize, xyscale, zscale, segmentation, cache_path, resampler = task
+    if cache_path is not None and os.path.isfile(cache_path):
+        return None, load_block(cache_path)
+
+    vfv = _open_volume(path)
     xm = vfv.shape[2]
     ym = vfv.shape[1]
     zm = vfv.shape[0]
-    vols = np.array(())
-    surfs = np.array(())
-    scale_tup = tuple((args.zscale, args.xyscale, args.xyscale))
-    out_shape = tuple(int(l / r) for l, r in zip(vfv.shape, scale_tup))
-    out_mask = np.zeros(out_shape).astype('uint8')
-
-    n = 1
-    n_blocks = (int(out_shape[2] / args.blocksize) + 1) * (int(out_shape[1] / args.blocksize) +
-                                                           1) * (int(out_shape[0] / args.blocksize) + 1)
-
-    for x in np.arange(0, out_shape[2], args.blocksize):
-        xr = int(x * xred)
-        xv1 = int(x * args.xyscale)
-        xv2 = int(np.clip((x + args.blocksize) * args.xyscale, 0, xm))
-        for y in np.arange(0, out_shape[1], args.blocksize):
-            yr = int(y * yred)
-            yv1 = int(y * args.xyscale)
-            yv2 = int(np.clip((y + args.blocksize) * args.xyscale, 0, ym))
-            for z in np.arange(0, out_shape[0], args.blocksize):
-                zr = int(z * zred)
-                if np.any(ms[zr:(zr + zstep), yr:(yr + ystep), xr:(xr + xstep)]):
-                    logger.info('processing block %d of %d', n, n_blocks)
-                    zmin = int(z * args.zscale)
-                    zmax = int(np.clip((z + args.blocksize) * args.zscale, 0, zm))
-                    block_ds = np.zeros((int((zmax - zmin) / args.zscale), int((yv2 - yv1) / args.xyscale),
-                                         int((xv2 - xv1) / args.xyscale))).astype('uint16')
-                    for zeta in np.arange(0, args.blocksize, 10):
-                        zv1 = int((z + zeta) * args.zscale)
-                        zv2 = int(np.clip((z + zeta + 10) * args.zscale, 0, zm))
-                        if zv1 < zm:
-                            block = vfv[zv1:zv2, yv1:yv2, xv1:xv2]
-                            clipped = np.clip(zeta + 10, 0, block_ds.shape[0])
-                            if clipped > zeta:
-                                block_ds[zeta:clipped,...] = resize(block,
-                                (np.minimum(10, block_ds.shape[0]-zeta), block_ds.shape[1],
-                                 block_ds.shape[2]), anti_aliasing=True, preserve_range=True)
-                    #tiff.imwrite('/home/silvestri/Lavoro/Experiments/Pini/block'+str(n)+'.tiff',block_ds)
-                    alveo = True
-                    try:
-                        alveomask = segment(block_ds, 180)
-                    except:
-                        logger.error('error while segmenting block %d', n)
-                        alveo = False
-                    if alveo:
-                        try:
-                            vol, surf = morpho(alveomask)
-                            vols = np.append(vols, vol)
-                            surfs = np.append(surfs, surf)
-                            out_mask[z:int(zmax / args.zscale),
-                                 y:int(yv2 / args.xyscale), x:int(xv2 / args.xyscale)] = alveomask.astype('uint8')
-                        except:
-                            logger.error('error while analyzing block %d', n)
-                n += 1
-
-    if args.outpath == '.':
-        filetif = join(getcwd(), args.name + '.tiff')
-        filev = join(getcwd(), args.name + '_vol.csv')
-        files = join(getcwd(), args.name + '_surf.csv')
+
+    xv1 = int(x * xyscale)
+    xv2 = int(np.clip((x + blocksize) * xyscale, 0, xm))
+    yv1 = int(y * xyscale)
+    yv2 = int(np.clip((y + blocksize) * xyscale, 0, ym))
+    zmin = int(z * zscale)
+    zmax = int(np.clip((z + blocksize) * zscale, 0, zm))
+    block_ds = np.zeros((int((zmax - zmin) / zscale), int((yv2 - yv1) / xyscale),
+                         int((xv2 - xv1) / xyscale))).astype('uint16')
+    for zeta in np.arange(0, blocksize, 10):
+        zv1 = int((z + zeta) * zscale)
+        zv2 = int(np.clip((z + zeta + 10) * zscale, 0, zm))
+        if zv1 < zm:
+            block = vfv[zv1:zv2, yv1:yv2, xv1:xv2]
+            clipped = np.clip(zeta + 10, 0, block_ds.shape[0])
+            if clipped > zeta:
+                shape = (np.minimum(10, block_ds.shape[0] - zeta), block_ds.shape[1], block_ds.shape[2])
+                if resampler == 'bin':
+                    block_ds[zeta:clipped, ...] = bin_resize(block, shape)
+                else:
+                    block_ds[zeta:clipped, ...] = resize(block, shape, anti_aliasing=True, preserve_range=True)
+
+    return block_ds, None
+
+
+def bin_resize(image, shape):
+    # downscales image to shape averaging the input voxels covered by each output voxel: a block mean for the axes
+    # with an integer factor, area weights for the others. The result is float32
+    import numpy as np
+
+    out = np.asarray(image)
+    # integer factors first, they are the cheapest to reduce
+    for axis in sorted(range(out.ndim), key=lambda a: out.shape[a] % shape[a] != 0):
+        m, n = out.shape[axis], int(shape[axis])
+        if m % n == 0:
+            out = out.reshape(out.shape[:axis] + (n, m // n) + out.shape[axis + 1:]).mean(axis=axis + 1,
+                                                                                           dtype='float32')
+        else:
+            out = np.moveaxis(np.tensordot(_bin_weights(m, n), out, axes=(1, axis)), 0, axis)
+    return out.astype('float32', copy=False)
+
+
+def _bin_weights(m, n):
+    # (n, m) matrix averaging m samples into n: each output covers an interval of m / n inputs, which contribute
+    # with the length of their overlap with it
+    import numpy as np
+
+    edges = np.arange(n + 1) * m / n
+    i = np.arange(m)
+    overlap = np.minimum(i + 1, edges[1:, None]) - np.maximum(i, edges[:-1, None])
+    return (np.clip(overlap, 0, None) * n / m).astype('float32')
+
+
+def analyze_block(task, block_ds, result=None):
+    # second part of process_block: segments and analyzes the block returned by fetch_block
+    import logging
+
+    if result is not None:
+        return result
+    n, segmentation, cache_path = task[1], task[8], task[9]
+
+    try:
+        alveomask = segment(block_ds, **segmentation)
+    except:
+        logging.getLogger(__name__).debug('segmentation of block %d failed', n, exc_info=True)
+        result = None, None, None, 'segment'
     else:
-        filetif = join(args.outpath, args.name + '.tiff')
-        filev = join(args.outpath, args.name + '_vol.csv')
-        files = join(args.outpath, args.name + '_surf.csv')
+        try:
+            vol, surf = morpho(alveomask)
+        except:
+            logging.getLogger(__name__).debug('analysis of block %d failed', n, exc_info=True)
+            result = None, None, None, 'morpho'
+        else:
+            result = alveomask.astype('uint8'), vol, surf, None
+
+    if cache_path is not None:
+        save_block(cache_path, result)
+    return result
+
+
+def write_worklist(path, work, params):
+    # work list file: a csv with one (block number, x, y, z, cost) row per block, after a line with the block
+    # parameters it was computed for
+    import numpy as np
+
+    np.savetxt(path, np.array(work, dtype='int64').reshape(-1, 5), fmt='%d', delimiter=',',
+               header=params + '\nn,x,y,z,cost')
+
 
-    tiff.imwrite(str(filetif), out_mask)
-    np.savetxt(str(filev), vols, delimiter=',', fmt='%d')
-    np.savetxt(str(files), surfs, delimiter=',', fmt='%d')
+def read_worklist(path, params):
+    import numpy as np
+
+    with open(path) as f:
+        header = f.readline().lstrip('#').strip()
+        if header != params:
+            raise ValueError('work list %s was computed for %s, not %s' % (path, header, params))
+        work = np.loadtxt(f, dtype='int64', delimiter=',', ndmin=2)
+    return [tuple(int(v) for v in w) for w in work]
+
+
+def shard_blocks(cost, shards):
+    # assigns each block to one of shards shards, balancing their total cost: blocks are taken from the most expensive
+    # and each goes to the shard with the lowest total so far
+    import numpy as np
+
+    totals = np.zeros(shards)
+    assigned = np.zeros(len(cost), dtype='int64')
+    for b in np.argsort(-np.asarray(cost), kind='stable'):
+        assigned[b] = np.argmin(totals)
+        totals[assigned[b]] += cost[b]
+    return assigned
+
+
+def block_cache(cache, volume, segmentation, blocksize, xyscale, zscale, resampler):
+    # cache directory for a set of analysis parameters: a subdirectory of cache named after a hash of the parameters
+    # (segmentation holds the keyword arguments of segment) and of the content of the vfv yml file, so that results of
+    # different runs are never mixed
+    import hashlib
+
+    key = hashlib.sha1(repr((sorted(segmentation.items()), blocksize, xyscale, zscale, resampler,
+                             os.path.abspath(volume))).encode())
+    with open(volume, 'rb') as f:
+        key.update(f.read())
+    path = os.path.join(cache, key.hexdigest()[:16])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def save_block(path, result):
+    # writes the result of process_block to path; the file appears only when complete, so a crash never leaves a
+    # partial block in the cache
+    import numpy as np
+
+    alveomask, vol, surf, status = result
+    empty = np.zeros(0)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, alveomask=empty if alveomask is None else alveomask, vol=empty if vol is None else vol,
+                 surf=empty if surf is None else surf, status='' if status is None else status)
+    os.replace(path + '.tmp', path)
+
+
+def load_block(path):
+    # reads a result written by save_block
+    import numpy as np
+
+    with np.load(path) as data:
+        status = str(data['status'])
+        if status:
+            return None, None, None, status
+        return data['alveomask'], data['vol'], data['surf'], None
+
+
+def _open_volume(path):
+    # one VirtualFusedVolume per thread, opened at the first block it reads
+    from zetastitcher import VirtualFusedVolume
+
+    if getattr(_volumes, 'path', None) != path:
+        _volumes.vfv = VirtualFusedVolume(path)
+        _volumes.path = path
+    return _volumes.vfv
 
 
 def mask(image, threshold, scale):
@@ -137,21 +415,36 @@ def mask(image, threshold, scale):
     return im3
 
 
-def segment(image, threshold):
+def segment(image, threshold, seeds='skeleton', h=2):
+    # seeds selects the watershed markers: 'skeleton' uses the long junction-to-end branches of the pruned skeleton,
+    # 'distance' the h-maxima of the distance transform, a much cheaper alternative
     from scipy.spatial.qhull import QhullError
     from scipy import spatial
     spatial.QhullError = QhullError
-    from skimage.morphology import binary_opening, ball, skeletonize_3d, remove_small_holes
+    from skimage.morphology import binary_opening, ball, skeletonize_3d, remove_small_holes, h_maxima
     import numpy as np
     import skan
-    from scipy.ndimage import distance_transform_edt
+    from scipy.ndimage import distance_transform_edt, maximum_filter
     from skimage.segmentation import watershed
     from skimage.measure import label
 
     im = image < threshold
 
-    # remove holes from binary data and extract pixel-wise skeleton
+    # remove holes from binary data
     ims = remove_small_holes(binary_opening(im, ball(3)), area_threshold=100000)
+
+    if seeds == 'distance':
+        # one marker per h-maximum of the distance transform
+        ed = distance_transform_edt(ims)
+        markers = label(h_maxima(ed, h))
+        if markers.max() == 0:
+            return markers.astype('int64')
+        wt = watershed(-ed, markers=markers, mask=ims, compactness=10)
+        # voxels touching an alveolus with a higher label are removed, so that alveoli stay apart in the binary mask
+        wtlab = np.logical_and(wt > 0, maximum_filter(wt, size=3) == wt).astype('int64')
+        return _filter_sizes(wtlab)
+
+    # extract pixel-wise skeleton
     sk = skeletonize_3d(ims)
 
     # if the skeleton is empty, directly return a black array
@@ -162,25 +455,13 @@ def segment(image, threshold):
     skeleton1 = skan.Skeleton(sk)
     branch_data1 = skan.summarize(skeleton1)
 
+    types = branch_data1['branch-type'].to_numpy()
+    long_j2e = np.logical_and(types == 1, branch_data1['branch-distance'].to_numpy() > 15)
     pruning = np.zeros(sk.shape)
-    for index, element in branch_data1.iterrows():  # IMPORTANT: max branch length is set to 15
-        if element['branch-type'] == 1 and element['branch-distance'] <= 15:
-            path = skeleton1.path_coordinates(index)
-            for px in path:
-                pruning[px[0], px[1], px[2]] = 255
-        elif element['branch-type'] == 3 or element['branch-type'] == 0:
-            path = skeleton1.path_coordinates(index)
-            for px in path:
-                pruning[px[0], px[1], px[2]] = 255
-    for index, element in branch_data1.iterrows():  # a correction to avoid removing connection points
-        if element['branch-type'] == 1 and element['branch-distance'] > 15:
-            path = skeleton1.path_coordinates(index)
-            for px in path:
-                pruning[px[0], px[1], px[2]] = 0
-        elif element['branch-type'] == 2:
-            path = skeleton1.path_coordinates(index)
-            for px in path:
-                pruning[px[0], px[1], px[2]] = 0
+    pruning[_path_pixels(skeleton1, np.flatnonzero(np.logical_or(np.logical_and(types == 1, ~long_j2e),
+                                                                    np.logical_or(types == 3, types == 0))))[0]] = 255
+    # a correction to avoid removing connection points
+    pruning[_path_pixels(skeleton1, np.flatnonzero(np.logical_or(long_j2e, types == 2)))[0]] = 0
 
     # extract pruned skeleton
     skpruned = sk - pruning
@@ -194,60 +475,73 @@ def segment(image, threshold):
 
     j2ef = j2e[j2e['branch-distance'] > 15]
 
-    # create skeleton image with different color for each branch
-    markers = np.zeros(sk.shape)
-    n = 0
-    m = j2ef.shape[0]
-    for index, element in branch_data.iterrows():
-        if element['branch-type'] == 1 and element['branch-distance'] > 15:  # j-2-e
-            n += 1
-            path = skeleton.path_coordinates(index)
-            for px in path:
-                markers[px[0], px[1], px[2]] = n
-        elif element['branch-type'] == 2:  # j-2-j
-            m += 1
-            path = skeleton.path_coordinates(index)
-            for px in path:
-                markers[px[0], px[1], px[2]] = m
+    # create skeleton image with different color for each branch: j-2-e branches are numbered from 1, j-2-j branches
+    # after them, both in branch order
+    types = branch_data['branch-type'].to_numpy()
+    long_j2e = np.logical_and(types == 1, branch_data['branch-distance'].to_numpy() > 15)
+    j2j = types == 2
+    colors = np.where(long_j2e, np.cumsum(long_j2e), np.where(j2j, j2ef.shape[0] + np.cumsum(j2j), 0))
+    pixels, branches = _path_pixels(skeleton, np.flatnonzero(colors))
+    # pixels shared by more branches (junctions) take the color of the last one
+    flat = np.ravel_multi_index(pixels, sk.shape)[::-1]
+    flat, last = np.unique(flat, return_index=True)
+    markers = np.zeros(sk.shape, dtype='int64')
+    markers.flat[flat] = colors[branches[::-1][last]]
 
     # separate different volumes using watershed
     ed = distance_transform_edt(ims)
-    wt = watershed(-ed, markers=markers.astype('int64'), mask=ims, compactness=10)
+    wt = watershed(-ed, markers=markers, mask=ims, compactness=10)
 
-    # cleanup watershed, preserving only alveoli with reasonable size
+    # cleanup watershed
     wtlab = np.copy(wt)
     wtlab[np.where(np.logical_and(wtlab < j2ef.shape[0], wtlab > 0))] = 1
     wtlab[np.where(wtlab >= j2ef.shape[0])] = 0
+    return _filter_sizes(wtlab)
+
+
+def _filter_sizes(wtlab):
+    # cleanup of a binary watershed mask, preserving only alveoli with reasonable size
+    import numpy as np
+    from skimage.measure import label
+
     labels = label(wtlab)
-    for n in range(labels.max() + 1):
-        s = np.sum(wtlab[labels == n])
-        if s < 700:
-            wtlab[labels == n] = 0
-        elif s > 70000:
-            wtlab[labels == n] = 0
+    sizes = np.bincount(labels.ravel())
+    wtlab[np.logical_or(sizes < 700, sizes > 70000)[labels]] = 0
     return wtlab
 
 
+def _path_pixels(skeleton, branches):
+    # pixels of the given branches of a skan Skeleton, as an index tuple, and the branch each of them belongs to. The
+    # pixels are read in bulk from the CSR path matrix, following the order of branches
+    import numpy as np
+
+    paths = skeleton.paths[branches]
+    coords = skeleton.coordinates[paths.indices].astype('intp')
+    return tuple(coords.T), np.repeat(branches, np.diff(paths.indptr))
+
+
 def morpho(alveomask):
     import numpy as np
     from scipy.spatial.qhull import QhullError
     from scipy import spatial
     spatial.QhullError = QhullError
+    from scipy.ndimage import find_objects
     from skimage.morphology import binary_dilation
     from skimage.measure import label
 
-    vol = np.array(())
-    surf = np.array(())
+    # statistics are reported for labels 0 (background) to max - 1
     labels = label(alveomask)
-    for n in np.arange(labels.max()):
-        temp = labels == n
-        tempo = temp.astype('float')
-        u = tempo.sum()
-        temp2 = binary_dilation(temp)
-        tempo2 = temp2.astype('float')
-        v = tempo2.sum()
-        vol = np.append(vol, u)
-        surf = np.append(surf, v - u)
+    nl = labels.max()
+    if nl == 0:
+        return np.array(()), np.array(())
+    vol = np.bincount(labels.ravel(), minlength=nl)[:nl].astype('float')
+
+    # the dilation grows a label by one voxel, so it is computed in the label bounding box enlarged by one voxel
+    surf = np.zeros(nl)
+    surf[0] = binary_dilation(labels == 0).sum() - vol[0]
+    for n, box in enumerate(find_objects(labels)[:nl - 1], start=1):
+        box = tuple(slice(max(sl.start - 1, 0), sl.stop + 1) for sl in box)
+        surf[n] = binary_dilation(labels[box] == n).sum() - vol[n]
 
     return vol, surf
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+
+def main():
+    import logging
+    import coloredlogs
+    import argparse
+    import time
+    import numpy as np
+    import tifffile as tiff
+    from skimage.measure import label
+    from alveoli_detector import segment
+
+    logger = logging.getLogger(__name__)
+    logging.basicConfig(format='[%(funcName)s] - %(asctime)s - %(message)s', level=logging.INFO)
+    coloredlogs.install(level='INFO', logger=logger)
+
+    parser = argparse.ArgumentParser(description="compare the skeleton and distance seeds of alveoli_detector.segment "
+                                                 "on the same block")
+    parser.add_argument('-i', '--input', help="block at analysis resolution (tiff)", metavar='PATH')
+    parser.add_argument('-t', '--threshold', help="segmentation threshold", type=float, default=180)
+    parser.add_argument('--hmax', help="minimum height of the distance maxima used as markers", type=float, default=2)
+    parser.add_argument('-o', '--output', help="if given, base path of the tiff masks of both modes", metavar='PATH')
+    args = parser.parse_args()
+
+    logger.info('reading block')
+    block = tiff.imread(args.input)
+
+    masks = {}
+    for seeds in ['skeleton', 'distance']:
+        logger.info('segmenting with %s seeds', seeds)
+        start = time.time()
+        masks[seeds] = segment(block, args.threshold, seeds=seeds, h=args.hmax) > 0
+        elapsed = time.time() - start
+        volumes = np.bincount(label(masks[seeds]).ravel())[1:]
+        if len(volumes) == 0:
+            volumes = np.zeros(1)
+        print('%s seeds: %d alveoli in %.1f s, volume %.0f +/- %.0f voxels (mean +/- std), median %.0f, total %d'
+              % (seeds, np.count_nonzero(volumes), elapsed, volumes.mean(), volumes.std(), np.median(volumes),
+                 volumes.sum()))
+        if args.output is not None:
+            tiff.imwrite(args.output + '_' + seeds + '.tiff', masks[seeds].astype('uint8') * 255)
+
+    overlap = np.count_nonzero(np.logical_and(masks['skeleton'], masks['distance']))
+    total = np.count_nonzero(masks['skeleton']) + np.count_nonzero(masks['distance'])
+    print('Dice coefficient of the two masks is %.3f' % (2 * overlap / total if total else 1))
+
+
+if __name__ == "__main__":
+    main()
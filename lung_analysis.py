@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+# marching cubes area of the 2x2x2 cell configurations, see _cell_areas
+_mc_areas = None
+
 
 def main():
     import logging
@@ -18,38 +21,68 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', help="input file base", metavar='PATH')
+    parser.add_argument('-j', '--jobs', help="number of components analyzed in parallel", type=int, default=1)
+    parser.add_argument('-b', '--batch', help="number of small components analyzed together in a single watershed",
+                        type=int, default=1)
+    parser.add_argument('-s', '--surface', help="surface estimator: a marching cubes mesh for each alveolus, or the "
+                                                "same areas from a lookup table for all alveoli of a component",
+                        choices=['marching_cubes', 'lut'], default='marching_cubes')
+    parser.add_argument('--surface-report', help="also compute surfaces with the other estimator and write a report "
+                                                 "of the discrepancy", action='store_true', default=False)
+    parser.add_argument('--slab', help="if given, read the images in slabs of this many z planes and label the "
+                                       "components out of core, for volumes that do not fit in memory", type=int)
     args = parser.parse_args()
 
-    logger.info('opening segmented image')
+    if args.slab:
+        logger.info('extracting alveoli from slabs of %d planes', args.slab)
+        volumes, surfaces = stream_alveoli(args.input, args.slab, args.jobs, args.batch, args.surface,
+                                           args.input + '_alveoli_image.tiff')
+        if args.surface_report:
+            logger.info('validating surfaces')
+            other = 'lut' if args.surface == 'marching_cubes' else 'marching_cubes'
+            check = stream_alveoli(args.input, args.slab, args.jobs, args.batch, other)[1]
+            surface_report(args.input + '_surface_report.txt', {args.surface: surfaces, other: check})
+    else:
+        logger.info('opening segmented image')
+
+        a = tiff.imread(args.input + '_Simple Segmentation.tiff')
+        b = a < 2
 
-    a = tiff.imread(args.input + '_Simple Segmentation.tiff')
-    b = a < 2
+        blabels = label(b)
+        bregions = regionprops(blabels)
+        sorted_regions = sorted(bregions, key=lambda x: x.area, reverse=True)
 
-    blabels = label(b)
-    bregions = regionprops(blabels)
-    sorted_regions = sorted(bregions, key=lambda x: x.area, reverse=True)
+        logger.info('extracting alveoli')
+        volumes, surfaces, alveoli_image = alveoli_finder(sorted_regions, b.shape, args.jobs, args.batch, args.surface)
 
-    logger.info('extracting alveoli')
-    volumes, surfaces, alveoli_image = alveoli_finder(sorted_regions, b.shape)
+        if args.surface_report:
+            logger.info('validating surfaces')
+            other = 'lut' if args.surface == 'marching_cubes' else 'marching_cubes'
+            check = alveoli_finder(sorted_regions, b.shape, args.jobs, args.batch, other)[1]
+            surface_report(args.input + '_surface_report.txt', {args.surface: surfaces, other: check})
 
     volvec = np.array(volumes) * 125 # volumes in um^3
     survec = np.array(surfaces) * 25 # volumes in um^2
     s2v = (survec/volvec) * 1000 # in mm-1
 
     logger.info('opening original image to get tissue volume')
-    u = tiff.imread(args.input + '.tiff')
-    v = rescale(u, 0.5, preserve_range=True)
-    v1 = v > 150
-    v2 = binary_closing(v1, footprint=np.ones((11, 11, 11)))
-    v2 = binary_fill_holes(v2)
-    vr = rescale(v2, 2, preserve_range=True)
-    norm = np.sum(vr).astype('float') * 125 / 1000000000 # volume in mm^3
+    if args.slab:
+        norm = tissue_volume(args.input, args.slab).astype('float') * 125 / 1000000000 # volume in mm^3
+    else:
+        u = tiff.imread(args.input + '.tiff')
+        v = rescale(u, 0.5, preserve_range=True)
+        v1 = v > 150
+        v2 = binary_closing(v1, footprint=np.ones((11, 11, 11)))
+        v2 = binary_fill_holes(v2)
+        vr = rescale(v2, 2, preserve_range=True)
+        norm = np.sum(vr).astype('float') * 125 / 1000000000 # volume in mm^3
 
 
     np.savetxt(args.input + '_volumes.csv', volvec, delimiter=',')
     np.savetxt(args.input + '_surfaces.csv', survec, delimiter=',')
     np.savetxt(args.input + '_surface_2_volume.csv', s2v, delimiter=',')
-    tiff.imwrite(args.input + '_alveoli_image.tiff', alveoli_image.astype('uint8'))
+    if not args.slab:
+        tiff.imwrite(args.input + '_alveoli_image.tiff', alveoli_image.astype('uint8'))
     print('Alveolar volume is ' + str(volvec.mean()) + '+/-' + str(volvec.std()) + ' um^3 (mean +/- std)')
     print('Alveolar surface is ' + str(survec.mean()) + '+/-' + str(survec.std()) + ' um^2 (mean +/- std)')
     print('Alveolar surface/volume ratio is ' + str(s2v.mean()) + '+/-' + str(s2v.std())
@@ -73,15 +106,252 @@ def main():
     logger.info('done')
 
 
-def alveoli_finder(sorted_regions, shape):
+def surface_report(path, surfaces):
+    # writes to path the discrepancy between the alveoli surfaces of two estimators, given as a dict estimator name:
+    # list of surfaces (in voxel units, same alveoli in the same order)
+    import numpy as np
+
+    (name1, s1), (name2, s2) = ((n, np.array(s, dtype='float')) for n, s in surfaces.items())
+    with open(path, 'w') as f:
+        if len(s1) != len(s2):
+            f.write('%s found %d alveoli and %s %d, surfaces cannot be compared\n' % (name1, len(s1), name2, len(s2)))
+            return
+        diff = np.abs(s1 - s2) / np.maximum(np.abs(s1), 1e-12)
+        f.write('%d alveoli\n' % len(s1))
+        f.write('total surface is %f with %s and %f with %s\n' % (s1.sum(), name1, s2.sum(), name2))
+        if len(s1) > 0:
+            f.write('relative discrepancy per alveolus is %g mean, %g max\n' % (diff.mean(), diff.max()))
+            f.write('absolute discrepancy per alveolus is %g max\n' % np.abs(s1 - s2).max())
+
+
+def stream_alveoli(base, slab, jobs=1, batch=1, surface='marching_cubes', image_path=None):
+    # out-of-core version of the labelling and alveoli_finder steps of main: the segmentation is read in slabs of
+    # slab z planes, so memory is bounded by a few slabs plus the components being assembled, and the alveoli image
+    # (if image_path is given) is written to disk through a memory map. Returns the volumes and surfaces in the same
+    # order as alveoli_finder on the components sorted by area
+    import logging
+    import coloredlogs
+    import numpy as np
+    import tifffile as tiff
+
+    logger = logging.getLogger(__name__)
+    logging.basicConfig(format='[%(funcName)s] - %(asctime)s - %(message)s', level=logging.INFO)
+    coloredlogs.install(level='INFO', logger=logger)
+
+    path = base + '_Simple Segmentation.tiff'
+    shape = _stack_shape(path)
+    final, components = label_slabs(path, shape, slab)
+
+    # same selection and order as main and alveoli_finder: largest first, ties in label order
+    keep = [c for c in np.argsort(-components['area'], kind='stable')
+            if candidate(components['area'][c], components['axis_major_length'][c],
+                         components['axis_minor_length'][c])]
+    logger.info('%d of %d components selected', len(keep), len(components['area']))
+
+    alveolim = tiff.memmap(image_path, shape=shape, dtype='uint8') if image_path is not None else None
+    found = [None] * len(keep)
+    regions = stream_regions(path, shape, slab, final, components, keep)
+    results = unordered_region_alveoli(regions, jobs, batch, surface)
+    for counter, (region, (im, vols, surfs)) in enumerate(results):
+        if counter % 100 == 0:
+            logger.info('processed %d of %d components', counter, len(keep))
+        if alveolim is not None:
+            zmin, ymin, xmin, zmax, ymax, xmax = region.bbox
+            alveolim[zmin:zmax, ymin:ymax, xmin:xmax] += im
+        found[region.rank] = (vols, surfs)
+    if alveolim is not None:
+        alveolim.flush()
+        del alveolim
+
+    volumes = [v for vols, surfs in found for v in vols]
+    surfaces = [s for vols, surfs in found for s in surfs]
+    return volumes, surfaces
+
+
+def label_slabs(path, shape, slab):
+    # labels the connected components of the segmentation (labels < 2) slab by slab, with the same (full)
+    # connectivity as label in main. Labels of touching components in adjacent slabs are merged with a union-find
+    # over the pairs of labels facing each other across the slab boundary. Returns a map from the slab labels
+    # (offset by the number of labels of the previous slabs, as in stream_regions) to the final labels, numbered in
+    # raster order like label does, and a dict of arrays with area, bbox and axis lengths of each final label
+    import numpy as np
+    from scipy.ndimage import find_objects
+    from skimage.measure import label
+
+    offset = 0
+    previous = None
+    pairs = []
+    areas = []
+    sums = []
+    bboxes = []
+    for z0 in range(0, shape[0], slab):
+        lab, n = label(_read_planes(path, z0, min(z0 + slab, shape[0])) < 2, return_num=True)
+        lab = lab.astype('int64')
+
+        # area, coordinate sums for the moments of inertia and bbox of each slab label
+        z, y, x = np.nonzero(lab)
+        ll = lab[z, y, x]
+        z = z + float(z0)
+        y = y.astype('float')
+        x = x.astype('float')
+        areas.append(np.bincount(ll, minlength=n + 1)[1:])
+        sums.append(np.stack([np.bincount(ll, w, minlength=n + 1)[1:]
+                              for w in (z, y, x, z * z, y * y, x * x, z * y, z * x, y * x)], axis=1))
+        bboxes.append(np.array([[s.start for s in sl] + [s.stop for s in sl] for sl in find_objects(lab)],
+                               dtype='int64').reshape(-1, 6) + [z0, 0, 0, z0, 0, 0])
+        del z, y, x, ll
+
+        # pairs of labels in contact across the boundary with the previous slab, 26-connectivity
+        first = np.where(lab[0] > 0, lab[0] + offset, 0)
+        if previous is not None:
+            ny, nx = first.shape
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    a = previous[max(0, -dy):ny - max(0, dy), max(0, -dx):nx - max(0, dx)]
+                    b = first[max(0, dy):ny - max(0, -dy), max(0, dx):nx - max(0, -dx)]
+                    touch = (a > 0) & (b > 0)
+                    pairs.append(np.unique(np.stack([a[touch], b[touch]], axis=1), axis=0))
+        previous = np.where(lab[-1] > 0, lab[-1] + offset, 0)
+        offset += n
+
+    # union-find, the root of each set is its smallest label
+    parent = np.arange(offset + 1)
+    for a, b in (np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype='int64')):
+        while parent[a] != a:
+            a = parent[a]
+        while parent[b] != b:
+            b = parent[b]
+        parent[max(a, b)] = min(a, b)
+    while np.any(parent[parent] != parent):
+        parent = parent[parent]
+
+    # the roots ordered by label are in raster order of their first voxel, since labels grow with z across slabs and
+    # in raster order within a slab
+    roots, final = np.unique(parent, return_inverse=True)
+    areas = np.concatenate(areas)
+    sums = np.concatenate(sums).reshape(-1, 9)
+    bboxes = np.concatenate(bboxes).reshape(-1, 6)
+    n = len(roots) - 1
+    members = final[1:] - 1
+    area = np.bincount(members, areas, minlength=n)
+    s = np.stack([np.bincount(members, sums[:, i], minlength=n) for i in range(9)], axis=1)
+    bbox = np.zeros((n, 6), dtype='int64')
+    bbox[:, :3] = np.iinfo('int64').max
+    np.minimum.at(bbox[:, :3], members, bboxes[:, :3])
+    np.maximum.at(bbox[:, 3:], members, bboxes[:, 3:])
+
+    # axis lengths as in regionprops, from the eigenvalues of the inertia tensor of the central moments
+    mean = s[:, :3] / area[:, None]
+    mu = s[:, 3:] - np.stack([mean[:, 0] * s[:, 0], mean[:, 1] * s[:, 1], mean[:, 2] * s[:, 2],
+                              mean[:, 1] * s[:, 0], mean[:, 2] * s[:, 0], mean[:, 2] * s[:, 1]], axis=1)
+    tensor = np.stack([mu[:, 1] + mu[:, 2], -mu[:, 3], -mu[:, 4],
+                       -mu[:, 3], mu[:, 0] + mu[:, 2], -mu[:, 5],
+                       -mu[:, 4], -mu[:, 5], mu[:, 0] + mu[:, 1]], axis=1).reshape(-1, 3, 3) / area[:, None, None]
+    ev = -np.sort(-np.clip(np.linalg.eigvalsh(tensor), 0, None), axis=1)
+    major = np.sqrt(np.maximum(10 * (ev[:, 0] + ev[:, 1] - ev[:, 2]), 0))
+    minor = np.sqrt(np.maximum(10 * (-ev[:, 0] + ev[:, 1] + ev[:, 2]), 0))
+
+    return final, {'area': area.astype('int64'), 'bbox': bbox, 'axis_major_length': major, 'axis_minor_length': minor}
+
+
+def stream_regions(path, shape, slab, final, components, keep):
+    # yields the components in keep (indices into components, see label_slabs) as regionprops-like objects with
+    # area, bbox and image, plus their rank in keep. The slabs are labelled again as in label_slabs, and each component
+    # is yielded as soon as the slab with its last plane has been read, so only the components crossing the current
+    # slab are held in memory
+    import numpy as np
+    from types import SimpleNamespace
+    from skimage.measure import label
+
+    keep = np.asarray(keep, dtype='int64')
+    bbox = components['bbox']
+    starts = keep[np.argsort(bbox[keep, 0], kind='stable')]
+    rank = np.zeros(len(bbox), dtype='int64')
+    rank[keep] = np.arange(len(keep))
+    offset = 0
+    started = 0
+    open_regions = {}
+    for z0 in range(0, shape[0], slab):
+        z1 = min(z0 + slab, shape[0])
+        lab, n = label(_read_planes(path, z0, z1) < 2, return_num=True)
+        lab = np.where(lab > 0, final[lab.astype('int64') + offset], 0)
+        offset += n
+
+        while started < len(starts) and bbox[starts[started], 0] < z1:
+            c = starts[started]
+            open_regions[c] = SimpleNamespace(area=components['area'][c], bbox=tuple(bbox[c]), rank=rank[c],
+                                              image=np.zeros(bbox[c, 3:] - bbox[c, :3], dtype='bool'))
+            started += 1
+
+        for c in list(open_regions):
+            zmin, ymin, xmin, zmax, ymax, xmax = bbox[c]
+            lo = max(zmin, z0)
+            hi = min(zmax, z1)
+            open_regions[c].image[lo - zmin:hi - zmin] = lab[lo - z0:hi - z0, ymin:ymax, xmin:xmax] == c + 1
+            if zmax <= z1:
+                yield open_regions.pop(c)
+
+
+def tissue_volume(base, slab):
+    # tissue mask of main (thresholded, closed and filled at half resolution) computed from the original image read
+    # in slabs of about slab planes. Each slab goes through the same steps as rescale(u, 0.5) on the whole volume,
+    # with the whole volume factors (n / round(n / 2) along z when the number of planes n is odd): anti-aliasing
+    # gaussian over the slab and a margin covering its kernel, linear interpolation along z at the source coordinates
+    # of the output planes, and zoom in y and x. Only the half resolution mask is held in memory. Returns the number
+    # of voxels of the mask at full resolution
+    import numpy as np
+    from skimage.morphology import binary_closing
+    from scipy.ndimage import binary_fill_holes, gaussian_filter, zoom
+
+    path = base + '.tiff'
+    shape = _stack_shape(path)
+    out_shape = np.maximum(np.round(np.array(shape) * 0.5), 1).astype(int)
+    factors = np.divide(shape, out_shape)
+    sigma = np.maximum(0, (factors - 1) / 2)
+    margin = int(4 * sigma[0] + 0.5)  # radius of the gaussian kernel along z
+    step = max(1, slab // 2)
+    planes = []
+    for o0 in range(0, out_shape[0], step):
+        # source coordinates of output planes o0:o1, 'grid' convention as in rescale
+        c = (np.arange(o0, min(o0 + step, out_shape[0])) + 0.5) * factors[0] - 0.5
+        i0 = np.floor(c).astype(int)
+        i1 = np.minimum(i0 + 1, shape[0] - 1)
+        lo = max(i0[0] - margin, 0)
+        block = gaussian_filter(_read_planes(path, lo, min(i1[-1] + 1 + margin, shape[0])).astype('float'), sigma,
+                                mode='mirror')
+        w = (c - i0)[:, None, None]
+        v = (1 - w) * block[i0 - lo] + w * block[i1 - lo]
+        v = zoom(v, (1, out_shape[1] / shape[1], out_shape[2] / shape[2]), order=1, mode='mirror', grid_mode=True)
+        planes.append(v > 150)
+    v1 = np.concatenate(planes)
+    del planes
+    v2 = binary_closing(v1, footprint=np.ones((11, 11, 11)))
+    v2 = binary_fill_holes(v2)
+    return np.sum(v2, dtype='int64') * 8
+
+
+def _stack_shape(path):
+    import tifffile as tiff
+
+    with tiff.TiffFile(path) as f:
+        return f.series[0].shape
+
+
+def _read_planes(path, z0, z1):
+    # planes z0:z1 of a tiff z stack, from a memory map when the file allows it
+    import tifffile as tiff
+
+    try:
+        return tiff.memmap(path, mode='r')[z0:z1]
+    except ValueError:
+        planes = tiff.imread(path, key=range(z0, z1))
+        return planes.reshape((z1 - z0,) + planes.shape[-2:])
+
+
+def alveoli_finder(sorted_regions, shape, jobs=1, batch=1, surface='marching_cubes'):
     import logging
     import coloredlogs
-    from skimage.morphology import skeletonize
-    from scipy.ndimage import distance_transform_edt
-    from skimage.segmentation import watershed
-    from skimage.measure import label, regionprops, marching_cubes, mesh_surface_area
     import numpy as np
-    import skan
 
     logger = logging.getLogger(__name__)
     logging.basicConfig(format='[%(funcName)s] - %(asctime)s - %(message)s', level=logging.INFO)
@@ -90,82 +360,360 @@ def alveoli_finder(sorted_regions, shape):
     alveolim = np.zeros(shape).astype('uint8')
     volumes = []  # list to append all volumes
     surfaces = []  # list to append all surfaces
-    counter = 0
-
-    # now, loop over connected components to identify alveoli in each of them
-    for region in sorted_regions:
-        # 2 controls to exclude too small regions (aspecific segmentation) and blood vessels (which are highly
-        # elliptical and large
-        if region.area > 500:  # THIS IS A PARAMETER
-            if counter % 100 == 0:
-                logger.info('processed %d of %d components', counter, len(sorted_regions))
-            counter += 1
-            e = region.axis_major_length / region.axis_minor_length
-            if (e < 2) or (region.area < 30000):  # THESE ARE PARAMETERS
-                # here the real stuff. Start with generating a binary image of the component
-                reg = region.image
-                zmin = region.bbox[0]
-                zmax = region.bbox[3]
-                ymin = region.bbox[1]
-                ymax = region.bbox[4]
-                xmin = region.bbox[2]
-                xmax = region.bbox[5]
-                # now extract the morphological skeleton and then a vectorial representation using skan
-                try:
-                    sk = skeletonize(reg)
-                    skeleton = skan.Skeleton(sk)
-                    branch_data = skan.summarize(skeleton)
-                    # refine the skeleton selecting only junction-to-end (j2e) branches which are long enough
-                    j2e = branch_data[np.logical_and(branch_data['branch-type'] == 1,
-                                                     branch_data['branch-distance'] >= 10)]
-                    # generate 'cleaned-up' skeleton image where all j2e have
-                    # clearly defined values, different from others
-                    n = 0
-                    m = j2e.shape[0]
-                    seeds = np.zeros_like(reg).astype('int64')
-                    for index, element in branch_data.iterrows():
-                        if element['branch-type'] == 1 and element['branch-distance'] >= 10:  # THIS IS A PARAMETER
-                            n += 1
-                            path = skeleton.path_coordinates(index)
-                            for px in path:
-                                seeds[px[0], px[1], px[2]] = n
-                        elif element['branch-type'] == 2 or element['branch-type'] == 0 or element['branch-type'] == 3:
-                            m += 1
-                            path = skeleton.path_coordinates(index)
-                            for px in path:
-                                seeds[px[0], px[1], px[2]] = m
-                    # further cleanup to remove spurious branches from thick bronchi
-                    ed = distance_transform_edt(reg)
-                    for n in np.arange(j2e.shape[0]):
-                        if np.max((seeds == n) * ed) > 10:  # THIS IS A PARAMETER
-                            seeds[seeds == n] = 0
-                    # now perform watershed
-                    water = watershed(-ed, markers=seeds.astype('int64'), mask=reg, compactness=0.01)
-                    water[water > j2e.shape[0]] = 0  # remove j2j watersheds
-                    alveolim[zmin:zmax, ymin:ymax, xmin:xmax] += (water > 0).astype('uint8') * 255
-                    # label the alveoli image
-                    comp = label(water)
-                    alveoli = regionprops(comp)
-                    for alveolo in alveoli:
-                        try:
-                            v, f, n, va = marching_cubes(alveolo.image)
-                            temp = mesh_surface_area(v, f)
-                            volumes.append(alveolo.area)
-                            surfaces.append(temp)
-                        except:
-                            ghi = 1
-                except:
-                    if region.area < 1500:
-                        alveolim[zmin:zmax, ymin:ymax, xmin:xmax] += (reg > 0).astype('uint8') * 255
-                        comp = label(reg)
-                        alveoli = regionprops(comp)
-                        for alveolo in alveoli:
-                            volumes.append(alveolo.area)
-                            v, f, n, va = marching_cubes(alveolo.image)
-                            surfaces.append(mesh_surface_area(v, f))
+
+    selected = [region for region in sorted_regions
+                if candidate(region.area, region.axis_major_length, region.axis_minor_length)]
+
+    # now, loop over connected components to identify alveoli in each of them, largest first since regions are
+    # sorted by area
+    results = region_alveoli(selected, jobs, batch, surface)
+    for counter, (region, (im, vols, surfs)) in enumerate(results):
+        if counter % 100 == 0:
+            logger.info('processed %d of %d components', counter, len(selected))
+        zmin = region.bbox[0]
+        zmax = region.bbox[3]
+        ymin = region.bbox[1]
+        ymax = region.bbox[4]
+        xmin = region.bbox[2]
+        xmax = region.bbox[5]
+        alveolim[zmin:zmax, ymin:ymax, xmin:xmax] += im
+        volumes += vols
+        surfaces += surfs
 
     return volumes, surfaces, alveolim
 
 
+def candidate(area, axis_major_length, axis_minor_length):
+    # 2 controls to exclude too small regions (aspecific segmentation) and blood vessels (which are highly
+    # elliptical and large
+    if area > 500:  # THIS IS A PARAMETER
+        e = axis_major_length / axis_minor_length
+        if (e < 2) or (area < 30000):  # THESE ARE PARAMETERS
+            return True
+    return False
+
+
+def region_alveoli(regions, jobs=1, batch=1, surface='marching_cubes'):
+    # yields (region, (image, volumes, surfaces)) of the alveoli in each region, in order. Components are
+    # independent, so with jobs > 1 they are analyzed by a pool of processes that takes them in order (largest first,
+    # since regions are sorted by area) as workers become free; only the component images are sent to the workers,
+    # and imap returns the results in order. With batch > 1, small components are analyzed in groups of batch
+    from collections import deque
+    from multiprocessing import Pool
+
+    groups = deque()
+
+    def tasks():
+        for group in component_batches(regions, batch):
+            groups.append(group)
+            yield [(region.image, region.area, surface) for region in group]
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(batch_alveoli, tasks())
+    else:
+        pool = None
+        results = map(batch_alveoli, tasks())
+    for group_results in results:
+        yield from zip(groups.popleft(), group_results)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def unordered_region_alveoli(regions, jobs=1, batch=1, surface='marching_cubes'):
+    # same as region_alveoli for regions produced lazily (see stream_regions): at most 2 * jobs groups are in flight,
+    # so regions are consumed only when a worker is about to need them, and results are yielded as they complete, so
+    # that a large component does not hold back the others
+    import itertools
+    import queue
+    from multiprocessing import Pool
+
+    if jobs <= 1:
+        yield from region_alveoli(regions, 1, batch, surface)
+        return
+
+    pool = Pool(jobs)
+    done = queue.Queue()
+    running = {}
+    for key, group in enumerate(itertools.chain(component_batches(regions, batch), [None])):
+        if group is not None:
+            running[key] = group
+            pool.apply_async(batch_alveoli, ([(region.image, region.area, surface) for region in group],),
+                             callback=lambda results, key=key: done.put((key, results)),
+                             error_callback=lambda error: done.put((None, error)))
+        while running and (group is None or len(running) >= 2 * jobs):
+            key_done, results = done.get()
+            if key_done is None:
+                raise results
+            yield from zip(running.pop(key_done), results)
+    pool.close()
+    pool.join()
+
+
+def component_batches(regions, batch):
+    # groups the regions into lists: one per region, or up to batch consecutive small regions
+    pending = []
+    for region in regions:
+        if batch > 1 and region.area < 5000:  # THIS IS A PARAMETER
+            pending.append(region)
+            if len(pending) == batch:
+                yield pending
+                pending = []
+        else:
+            if pending:
+                yield pending
+                pending = []
+            yield [region]
+    if pending:
+        yield pending
+
+
+def batch_alveoli(components):
+    # results of component_alveoli for a list of components. The components are stacked along z in one volume,
+    # separated by empty slices, so that skeletonization and skan run once for all of them. Distance transform and
+    # watershed stay per component: the first does not take the border of the component image as background, and the
+    # order in which the second floods ties would depend on the other components. The result of each component is
+    # the same as when it is analyzed alone
+    from skimage.morphology import skeletonize
+    from scipy.ndimage import distance_transform_edt
+    from skimage.segmentation import watershed
+    import numpy as np
+    import skan
+
+    if len(components) == 1:
+        return [component_alveoli(components[0])]
+
+    starts = np.cumsum([0] + [reg.shape[0] + 2 for reg, area, surface in components])
+    shape = (starts[-1], max(c[0].shape[1] for c in components), max(c[0].shape[2] for c in components))
+    boxes = [(slice(z, z + reg.shape[0]), slice(0, reg.shape[1]), slice(0, reg.shape[2]))
+             for (reg, area, surface), z in zip(components, starts)]
+    stack = np.zeros(shape, dtype='bool')
+    # the distance transform is computed per component, the border of the component image not being background
+    ed = np.zeros(shape)
+    for (reg, area, surface), box in zip(components, boxes):
+        stack[box] = reg
+        ed[box] = distance_transform_edt(reg)
+
+    try:
+        sk = skeletonize(stack)
+        # skan fails on skeletons of a single voxel: those components are analyzed alone, as it is their fallback
+        alone = [np.count_nonzero(sk[box]) < 2 for box in boxes]
+        for box, a in zip(boxes, alone):
+            if a:
+                sk[box] = 0
+        if all(alone):
+            return [component_alveoli(c) for c in components]
+        skeleton = skan.Skeleton(sk)
+        branch_data = skan.summarize(skeleton)
+        # j2e branches long enough are numbered first, the others after them, both in branch order
+        types = branch_data['branch-type'].to_numpy()
+        j2e = np.logical_and(types == 1, branch_data['branch-distance'].to_numpy() >= 10)  # THIS IS A PARAMETER
+        other = np.logical_or(types == 2, np.logical_or(types == 0, types == 3))
+        colors = np.where(j2e, np.cumsum(j2e), np.where(other, j2e.sum() + np.cumsum(other), 0))
+        owner = np.searchsorted(starts, skeleton.coordinates[skeleton.paths.indices[skeleton.paths.indptr[:-1]], 0],
+                                side='right') - 1
+        seeds = _paint_branches(skeleton, colors, shape)
+        # further cleanup to remove spurious branches from thick bronchi; as in component_alveoli, the last j2e
+        # branch of each component is not checked
+        last = np.zeros(len(components), dtype='int64')
+        np.maximum.at(last, owner[j2e], colors[j2e])
+        checked = colors[np.logical_and(j2e, colors != last[owner])]
+        seeds[np.isin(seeds, checked[labelled_maximum(ed, seeds, checked) > 10])] = 0  # THIS IS A PARAMETER
+    except:
+        return [component_alveoli(c) for c in components]
+
+    results = []
+    for (reg, area, surface), box, a in zip(components, boxes, alone):
+        if a:
+            results.append(component_alveoli((reg, area, surface)))
+            continue
+        # now perform watershed
+        water = watershed(-ed[box], markers=seeds[box], mask=reg, compactness=0.01)
+        water[water > j2e.sum()] = 0  # remove j2j watersheds
+        results.append(_water_alveoli(water, surface))
+    return results
+
+
+def labelled_maximum(values, labels, index):
+    # np.max((labels == n) * values) for each label n in index, in a single pass over the image. The reduction is the
+    # maximum of values over the voxels of the label, floored at 0 (the value of all other voxels), and 0 for labels
+    # that are not in the image
+    from scipy.ndimage import maximum
+    import numpy as np
+
+    index = np.asarray(index)
+    if index.size == 0:
+        return np.zeros(0)
+    return np.maximum(np.asarray(maximum(values, labels, index), dtype='float'), 0)
+
+
+def _paint_branches(skeleton, colors, shape):
+    # image of the branches of a skan Skeleton with a nonzero color, painted in branch order; pixels shared by more
+    # branches take the color of the last one
+    import numpy as np
+
+    branches = np.flatnonzero(colors)
+    paths = skeleton.paths[branches]
+    pixels = tuple(skeleton.coordinates[paths.indices].astype('intp').T)
+    owner = np.repeat(branches, np.diff(paths.indptr))
+    flat, last = np.unique(np.ravel_multi_index(pixels, shape)[::-1], return_index=True)
+    painted = np.zeros(shape, dtype='int64')
+    painted.flat[flat] = colors[owner[::-1][last]]
+    return painted
+
+
+def component_alveoli(task):
+    # alveoli of one connected component: task is the binary image of the component, its area and the surface
+    # estimator of _water_alveoli. Returns the image of the alveoli found (to be added to the component bounding box),
+    # their volumes and surfaces
+    from skimage.morphology import skeletonize
+    from scipy.ndimage import distance_transform_edt
+    from skimage.segmentation import watershed
+    from skimage.measure import label, regionprops, marching_cubes, mesh_surface_area
+    import numpy as np
+    import skan
+
+    reg, area, surface = task
+    alveolim = np.zeros(reg.shape).astype('uint8')
+    volumes = []
+    surfaces = []
+
+    # now extract the morphological skeleton and then a vectorial representation using skan
+    try:
+        sk = skeletonize(reg)
+        skeleton = skan.Skeleton(sk)
+        branch_data = skan.summarize(skeleton)
+        # refine the skeleton selecting only junction-to-end (j2e) branches which are long enough
+        j2e = branch_data[np.logical_and(branch_data['branch-type'] == 1,
+                                         branch_data['branch-distance'] >= 10)]
+        # generate 'cleaned-up' skeleton image where all j2e have
+        # clearly defined values, different from others
+        n = 0
+        m = j2e.shape[0]
+        seeds = np.zeros_like(reg).astype('int64')
+        for index, element in branch_data.iterrows():
+            if element['branch-type'] == 1 and element['branch-distance'] >= 10:  # THIS IS A PARAMETER
+                n += 1
+                path = skeleton.path_coordinates(index)
+                for px in path:
+                    seeds[px[0], px[1], px[2]] = n
+            elif element['branch-type'] == 2 or element['branch-type'] == 0 or element['branch-type'] == 3:
+                m += 1
+                path = skeleton.path_coordinates(index)
+                for px in path:
+                    seeds[px[0], px[1], px[2]] = m
+        # further cleanup to remove spurious branches from thick bronchi; the last j2e branch is not checked
+        ed = distance_transform_edt(reg)
+        checked = np.arange(1, j2e.shape[0])
+        seeds[np.isin(seeds, checked[labelled_maximum(ed, seeds, checked) > 10])] = 0  # THIS IS A PARAMETER
+        # now perform watershed
+        water = watershed(-ed, markers=seeds.astype('int64'), mask=reg, compactness=0.01)
+        water[water > j2e.shape[0]] = 0  # remove j2j watersheds
+        return _water_alveoli(water, surface)
+    except:
+        if area < 1500:
+            alveolim += (reg > 0).astype('uint8') * 255
+            comp = label(reg)
+            alveoli = regionprops(comp)
+            for alveolo in alveoli:
+                volumes.append(alveolo.area)
+                v, f, n, va = marching_cubes(alveolo.image)
+                surfaces.append(mesh_surface_area(v, f))
+
+    return alveolim, volumes, surfaces
+
+
+def _water_alveoli(water, surface='marching_cubes'):
+    # image, volumes and surfaces of the alveoli of the watershed of a component. surface is the area estimator:
+    # 'marching_cubes' meshes each alveolus, 'lut' computes the same areas for all alveoli at once (alveoli_surfaces)
+    from skimage.measure import label, regionprops, marching_cubes, mesh_surface_area
+    from scipy.ndimage import find_objects
+    import numpy as np
+
+    volumes = []
+    surfaces = []
+    # label the alveoli image
+    comp = label(water)
+    if surface == 'lut':
+        # alveoli are kept when marching_cubes(alveolo.image) works: a bounding box of at least 2 voxels per side,
+        # not completely filled
+        areas = alveoli_surfaces(comp)
+        counts = np.bincount(comp.ravel())
+        for n, box in enumerate(find_objects(comp), start=1):
+            sides = [sl.stop - sl.start for sl in box]
+            if min(sides) >= 2 and counts[n] < np.prod(sides):
+                volumes.append(float(counts[n]))
+                surfaces.append(areas[n])
+        return (water > 0).astype('uint8') * 255, volumes, surfaces
+
+    alveoli = regionprops(comp)
+    for alveolo in alveoli:
+        try:
+            v, f, n, va = marching_cubes(alveolo.image)
+            temp = mesh_surface_area(v, f)
+            volumes.append(alveolo.area)
+            surfaces.append(temp)
+        except:
+            ghi = 1
+    return (water > 0).astype('uint8') * 255, volumes, surfaces
+
+
+def alveoli_surfaces(comp):
+    # marching cubes surface area of every label of comp, in one pass over the image (element 0 is the background).
+    # The mesh of a binary image is made of the triangles of each of its 2x2x2 cells, which depend only on which
+    # corners of the cell are inside: a cell of configuration c adds _cell_areas()[c] to the area of the label. As
+    # for marching_cubes(alveolo.image), only the cells inside the bounding box of the label are counted
+    from scipy.ndimage import find_objects
+    import numpy as np
+
+    areas = np.zeros(comp.max() + 1)
+    if min(comp.shape) < 2 or len(areas) == 1:
+        return areas
+    # first and last cell of the bounding box of each label
+    boxes = find_objects(comp)
+    first = np.array([[0, 0, 0]] + [[sl.start for sl in box] for box in boxes])
+    last = np.array([[0, 0, 0]] + [[sl.stop - 2 for sl in box] for box in boxes])
+
+    z, y, x = comp.shape
+    corners = [comp[dz:z - 1 + dz, dy:y - 1 + dy, dx:x - 1 + dx] for dz in (0, 1) for dy in (0, 1) for dx in (0, 1)]
+    # only cells with different labels at their corners have a surface
+    mixed = np.zeros(corners[0].shape, dtype='bool')
+    for c in corners[1:]:
+        mixed |= c != corners[0]
+    cells = np.nonzero(mixed)
+    corners = [c[cells] for c in corners]
+
+    lut = _cell_areas()
+    for k, lab in enumerate(corners):
+        # each label of a cell is counted at its first corner
+        count = lab > 0
+        for c in corners[:k]:
+            count &= c != lab
+        config = np.zeros(len(lab), dtype='int64')
+        for j, c in enumerate(corners):
+            config |= (c == lab).astype('int64') << j
+        for axis in range(3):
+            count &= np.logical_and(cells[axis] >= first[lab, axis], cells[axis] <= last[lab, axis])
+        areas += np.bincount(lab[count], weights=lut[config[count]], minlength=len(areas))
+    return areas
+
+
+def _cell_areas():
+    # marching cubes area of a 2x2x2 binary cell for each of the 256 configurations; bit j of the configuration is the
+    # corner (j >> 2 & 1, j >> 1 & 1, j & 1)
+    from skimage.measure import marching_cubes, mesh_surface_area
+    import numpy as np
+
+    global _mc_areas
+    if _mc_areas is None:
+        _mc_areas = np.zeros(256)
+        for c in range(1, 255):
+            cell = np.array([(c >> j) & 1 for j in range(8)], dtype='float').reshape(2, 2, 2)
+            v, f, n, va = marching_cubes(cell)
+            _mc_areas[c] = mesh_surface_area(v, f)
+    return _mc_areas
+
+
 if __name__ == "__main__":
     main()
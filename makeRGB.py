@@ -9,6 +9,7 @@ def main():
     import logging
     import coloredlogs
     import argparse
+    from niftiutils import intensity_lut
 
     logger = logging.getLogger(__name__)
     logging.basicConfig(format='[%(funcName)s] - %(asctime)s - %(message)s', level=logging.INFO)
@@ -36,11 +37,13 @@ def main():
 
     color = np.zeros((3, prova.shape[0], prova.shape[1])).astype('uint8')
 
+    # min/max normalization of 8/16 bit images to 0-255, done with one look-up per pixel
+    lut_r = intensity_lut(args.min_r, 1, args.max_r - args.min_r)
+    lut_g = intensity_lut(args.min_g, 1, args.max_g - args.min_g)
+
     for n in range(len(lista1)):
-        red = (np.clip(((tiff.imread(os.path.join(args.red, lista2[n])).astype('float') - args.min_r) /
-                        (args.max_r - args.min_r)), 0, 1) * 255).astype('uint8')
-        green = (np.clip(((tiff.imread(os.path.join(args.green, lista1[n])).astype('float') - args.min_g) /
-                          (args.max_g - args.min_g)), 0, 1) * 255).astype('uint8')
+        red = lut_r[tiff.imread(os.path.join(args.red, lista2[n]))]
+        green = lut_g[tiff.imread(os.path.join(args.green, lista1[n]))]
         green2 = translate(green, args.x, args.y)
         color[0, ...] = red[...]
         color[1, ...] = green2[...]
@@ -20,6 +20,8 @@ def main():
                         type=int)
     parser.add_argument('-t', '--thickness', help="thickness of transition (in slices)", default=10,
                         metavar="# OF SLICES")
+    parser.add_argument('-p', '--profile', help="feathering profile of the transition", default='linear',
+                        choices=['linear', 'cosine', 'smoothstep'])
     parser.add_argument('-c', '--convert', help="convert back to 8 bit (if not already)", action='store_true')
     parser.add_argument('-ng', '--nogamma', help="add 'nogamma' in output file name", action='store_true')
     args = parser.parse_args()
@@ -42,7 +44,8 @@ def main():
     else:
         out_path = os.path.join(args.out_path, name + pattern)
     logger.info('merging images...')
-    merge(f_path=f_path, b_path=b_path, ms=args.middle_shift, t=args.thickness, out_path=out_path)
+    merge(f_path=f_path, b_path=b_path, ms=args.middle_shift, t=args.thickness, out_path=out_path,
+          profile=args.profile)
     logger.info('done')
 
 
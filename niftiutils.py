@@ -1,318 +1,757 @@
 #!/usr/bin/env python3
+import io
 
+# compression of .nii.gz outputs: number of threads (None means one per cpu), gzip level, size of the blocks that
+# are compressed independently, each one as a gzip member, and maximum bytes of blocks waiting for compression or
+# writing, whatever the number of threads. Change them with set_compression
+gzip_workers = None
+gzip_level = 1
+gzip_block = 2 ** 24
+gzip_pending = 2 ** 27
 
-def conv8bit(in_path, out_path=None):
-    import nibabel as nib
-    import os.path
-    import logging
 
-    logger = logging.getLogger(__name__)
-    nifti = nib.load(in_path)
-    data = nifti.get_fdata()
-    logger.info('input image loaded')
+def conv8bit(in_path, out_path=None, clip=False, in_range=None, slab=100):
+    return convdtype(in_path, out_path, 'uint8', suffix='_8bit', clip=clip, in_range=in_range, slab=slab)
 
-    nifti8 = nib.Nifti1Image(data.astype('uint8'), None)
-    logger.info('image converted')
-    nifti8.header['pixdim'] = nifti.header['pixdim']
-    nifti8.header['xyzt_units'] = nifti.header['xyzt_units']
 
-    # 2 is the NIFTI code for unsigned char, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti8.header['datatype'] = 2
-    nifti8.header['bitpix'] = 8
+def conv16bit(in_path, out_path=None, clip=False, in_range=None, slab=100):
+    return convdtype(in_path, out_path, 'uint16', suffix='_16bit', clip=clip, in_range=in_range, slab=slab)
 
-    if out_path is None:
-        base, filename = os.path.split(in_path)
-        name, ext = os.path.splitext(filename)
-        name2, ext2 = os.path.splitext(name)
-        if ext2 == '':
-            out_path = os.path.join(base, name + "_8bit" + ext)
-        else:
-            out_path = os.path.join(base, name2 + "_8bit" + ext2 + ext)
-    nib.save(nifti8, out_path)
-    logger.info('output image saved to %s', out_path)
-    return out_path
 
-
-def conv16bit(in_path, out_path=None):
+def convdtype(in_path, out_path, dtype, suffix=None, clip=False, in_range=None, slab=100):
+    # converts a NIfTI image to dtype reading and writing slabs of z planes, so that the whole image is never in
+    # memory. By default values are simply cast; with clip they are saturated to the range of dtype, and with
+    # in_range=(min, max) they are linearly rescaled from (min, max) to the full range of dtype
     import nibabel as nib
+    import numpy as np
     import os.path
     import logging
 
     logger = logging.getLogger(__name__)
-    nifti = nib.load(in_path)
-    data = nifti.get_fdata()
-    logger.info('input image loaded')
-
-    nifti16 = nib.Nifti1Image(data.astype('uint16'), None)
-    logger.info('image converted')
-    nifti16.header['pixdim'] = nifti.header['pixdim']
-    nifti16.header['xyzt_units'] = nifti.header['xyzt_units']
-
-    # 512 is the NIFTI code for unsigned char, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti16.header['datatype'] = 512
-    nifti16.header['bitpix'] = 16
+    nifti = load(in_path)
+    shape = nifti.shape
+    info = np.iinfo(dtype)
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header['pixdim'] = nifti.header['pixdim']
+    header['xyzt_units'] = nifti.header['xyzt_units']
+
+    def slabs():
+        for z in range(0, shape[2], slab):
+            block = np.asarray(nifti.dataobj[..., z:(z + slab)])
+            if in_range is not None:
+                block = block.astype('float32')
+                block -= in_range[0]
+                block *= (info.max - info.min) / (in_range[1] - in_range[0])
+                block += info.min
+                block = block.clip(info.min, info.max)
+            elif clip:
+                block = block.clip(info.min, info.max)
+            yield block.astype(dtype)
+            logger.debug('converted slices %d to %d', z, min(z + slab, shape[2]))
 
     if out_path is None:
         base, filename = os.path.split(in_path)
         name, ext = os.path.splitext(filename)
         name2, ext2 = os.path.splitext(name)
         if ext2 == '':
-            out_path = os.path.join(base, name + "_16bit" + ext)
+            out_path = os.path.join(base, name + suffix + ext)
         else:
-            out_path = os.path.join(base, name2 + "_16bit" + ext2 + ext)
-    nib.save(nifti16, out_path)
+            out_path = os.path.join(base, name2 + suffix + ext2 + ext)
+    save_slabs(header, slabs(), out_path)
     logger.info('output image saved to %s', out_path)
     return out_path
 
 
-def convertImage(in_path, out_path, reverse=False, expand=False, bs=100, x_final=0.025, y_final=0.025, z_final=0.025,
-                 x_pix=0.0104, y_pix=0.0104, z_pix=0.01, nl=110, gamma=0.3, mp=99.9, top=-1, flip=False, mask=None):
+def save(nifti, out_path, slab=100):
+    # same as nib.save for single file NIfTI images, going through save_slabs
+    import numpy as np
+
+    nifti.update_header()
+    data = np.asanyarray(nifti.dataobj)
+    save_slabs(nifti.header, (data[..., z:(z + slab)] for z in range(0, data.shape[2], slab)), out_path)
+
+
+def save_slabs(header, slabs, out_path):
+    # writes a single file NIfTI image (.nii or .nii.gz) from an iterable of z slabs (x, y, dz) covering the shape
+    # set in header. The image data is stored in Fortran order, so each slab is a contiguous piece of the file
     import numpy as np
     import nibabel as nib
+    from io import BytesIO
+
+    header = nib.Nifti1Header.from_header(header)
+    # the data is written as is, without scaling; vox_offset = 0 lets write_to place it right after the header
+    # and its extensions
+    header.set_slope_inter(1, 0)
+    header.set_data_offset(0)
+    dtype = header.get_data_dtype()
+
+    def chunks():
+        head = BytesIO()
+        header.write_to(head)
+        head.write(b'\x00' * (header.get_data_offset() - head.tell()))
+        yield head.getvalue()
+        for block in slabs:
+            yield np.asarray(block, dtype=dtype).tobytes(order='F')
+
+    if out_path.endswith('.gz'):
+        write_gzip(chunks(), out_path)
+    else:
+        with open(out_path, 'wb') as f:
+            for chunk in chunks():
+                f.write(chunk)
+
+
+def set_compression(workers=None, level=None, block=None, pending=None):
+    global gzip_workers, gzip_level, gzip_block, gzip_pending
+
+    if workers is not None:
+        gzip_workers = workers
+    if level is not None:
+        gzip_level = level
+    if block is not None:
+        gzip_block = block
+    if pending is not None:
+        gzip_pending = pending
+
+
+def write_gzip(chunks, out_path, workers=None, level=None, block=None, pending=None):
+    # writes the concatenation of the byte strings in chunks as a multi-member gzip file: the data is cut in blocks
+    # that are compressed in parallel by a thread pool (zlib releases the GIL) and written in order. Any gzip reader
+    # (nibabel, ITK/ANTs, zcat) reads the members back as a single stream, while load can use them for random access
+    import os
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    if workers is None:
+        workers = gzip_workers if gzip_workers is not None else os.cpu_count()
+    if level is None:
+        level = gzip_level
+    if block is None:
+        block = gzip_block
+    if pending is None:
+        pending = gzip_pending
+    # blocks in flight: 2 per worker to keep them busy, but within pending bytes (at least one block)
+    window = max(1, min(2 * workers, pending // block))
+
+    def blocks():
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= block:
+                yield bytes(buffer[:block])
+                del buffer[:block]
+        if len(buffer) > 0:
+            yield bytes(buffer)
+
+    # an index left by a previous version of the file is no longer valid
+    if os.path.exists(out_path + '.gzidx'):
+        os.remove(out_path + '.gzidx')
+
+    with open(out_path, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = deque()
+        for data in blocks():
+            futures.append(pool.submit(_gzip_member, data, level))
+            if len(futures) >= window:
+                f.write(futures.popleft().result())
+        while futures:
+            f.write(futures.popleft().result())
+
+
+def _gzip_member(data, level):
+    # a complete gzip member holding data. Like in BGZF, the header has an extra field ('AT') with the total size of
+    # the member, so that gzip_index can hop from one member to the next without inflating them
+    import struct
+    import zlib
+
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = c.compress(data) + c.flush()
+    # magic, deflate, FEXTRA flag, mtime 0, no extra flags, unknown OS, then the 8 bytes of extra field
+    head = struct.pack('<4BIBBH2sHI', 0x1f, 0x8b, 8, 4, 0, 0, 255, 8, b'AT', 4, 28 + len(body))
+    return head + body + struct.pack('<2I', zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def gzip_index(path):
+    # offsets of the members of a gzip file: an (n + 1, 2) array whose rows are the compressed and uncompressed
+    # offsets of each member, followed by the compressed and uncompressed sizes of the file. Member sizes are read
+    # from the header extra field written by write_gzip (or by bgzip); if a member does not have it, the index stops
+    # there and the uncompressed size is set to -1. Indexes of multi-member files are cached in path + '.gzidx'
+    import numpy as np
+    import os
+    import struct
+
+    idx_path = path + '.gzidx'
+    size = os.path.getsize(path)
+    if os.path.exists(idx_path) and os.path.getmtime(idx_path) >= os.path.getmtime(path):
+        with open(idx_path, 'rb') as f:
+            index = np.load(f)
+        if index[-1, 0] == size:
+            return index
+
+    rows = []
+    coff = 0
+    uoff = 0
+    with open(path, 'rb') as f:
+        while coff < size:
+            f.seek(coff)
+            head = f.read(12)
+            if len(head) < 12 or head[:3] != b'\x1f\x8b\x08':
+                # trailing padding
+                break
+            rows.append((coff, uoff))
+            msize = None
+            if head[3] & 4:
+                xlen = struct.unpack('<H', head[10:12])[0]
+                extra = f.read(xlen)
+                i = 0
+                while i + 4 <= xlen:
+                    sid = extra[i:(i + 2)]
+                    slen = struct.unpack('<H', extra[(i + 2):(i + 4)])[0]
+                    if sid == b'AT' and slen == 4:
+                        msize = struct.unpack('<I', extra[(i + 4):(i + 8)])[0]
+                    elif sid == b'BC' and slen == 2:
+                        msize = struct.unpack('<H', extra[(i + 4):(i + 6)])[0] + 1
+                    i += 4 + slen
+            if msize is None:
+                # no size information: the uncompressed size is unknown and the rest of the file can only be read
+                # sequentially
+                uoff = -1
+                break
+            f.seek(coff + msize - 4)
+            uoff += struct.unpack('<I', f.read(4))[0]
+            coff += msize
+    rows.append((size, uoff))
+    index = np.array(rows, dtype='int64')
+
+    # only an index allowing random access is worth caching
+    if index.shape[0] > 2 and uoff >= 0:
+        try:
+            with open(idx_path, 'wb') as f:
+                np.save(f, index)
+        except OSError:
+            pass
+    return index
+
+
+class _GzipMemberReader(io.RawIOBase):
+    # read-only, seekable file over a multi-member gzip file: a read only inflates the members it overlaps, the last
+    # one being kept to serve consecutive small reads
+
+    def __init__(self, path, index):
+        super().__init__()
+        self.name = path
+        self.index = index
+        self.f = open(path, 'rb')
+        self.pos = 0
+        self.member = -1
+        self.data = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.index[-1, 1]
+        self.pos = offset
+        return self.pos
+
+    def read(self, size=-1):
+        import numpy as np
+        import zlib
+
+        end = self.index[-1, 1]
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        parts = []
+        while self.pos < end:
+            k = int(np.searchsorted(self.index[:-1, 1], self.pos, side='right')) - 1
+            if k != self.member:
+                self.f.seek(self.index[k, 0])
+                self.data = zlib.decompress(self.f.read(self.index[k + 1, 0] - self.index[k, 0]), 31)
+                self.member = k
+            start = self.pos - self.index[k, 1]
+            piece = self.data[start:(start + end - self.pos)]
+            parts.append(piece)
+            self.pos += len(piece)
+        return b''.join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def load(in_path):
+    # nib.load, with random access to .nii.gz images made of gzip members of known size (as written by save): reading
+    # a slab through dataobj only inflates the members holding it. Other .nii.gz images (e.g. written by ANTs or
+    # nibabel as a single gzip member) are opened with indexed_gzip, whose seek points are cached in
+    # in_path + '.igzidx', so that only the first load inflates the whole file. Without indexed_gzip, and for
+    # uncompressed images, nib.load is used keeping the file open: otherwise every slab read reopens a .nii.gz and
+    # inflates it from the start, so reading the slabs in increasing z would cost quadratic time
+    import nibabel as nib
+    from nibabel.fileholders import FileHolder
+
+    if in_path.endswith('.gz'):
+        index = gzip_index(in_path)
+        if index.shape[0] > 2 and index[-1, 1] >= 0:
+            f = _GzipMemberReader(in_path, index)
+            return nib.Nifti1Image.from_file_map({'image': FileHolder(fileobj=f)})
+        f = _indexed_gzip(in_path)
+        if f is not None:
+            return nib.Nifti1Image.from_file_map({'image': FileHolder(fileobj=f)})
+    return nib.load(in_path, keep_file_open=True)
+
+
+def _indexed_gzip(path):
+    # seekable indexed_gzip file over path, importing its index from path + '.igzidx' if it is up to date, or building
+    # it with a full pass and saving it there. None if indexed_gzip is not installed
     import os
-    import logging
-    from zetastitcher import InputFile
-    from skimage.transform import rescale
-
-    logger = logging.getLogger(__name__)
-    handle = InputFile(in_path)
-    in_image = handle.whole()
-    logger.info('input image loaded')
 
-    if mask is not None:
-        in_image = in_image * mask
+    try:
+        import indexed_gzip
+    except ImportError:
+        return None
+
+    idx_path = path + '.igzidx'
+    f = indexed_gzip.IndexedGzipFile(path)
+    if os.path.exists(idx_path) and os.path.getmtime(idx_path) >= os.path.getmtime(path):
+        try:
+            f.import_index(idx_path)
+            return f
+        except OSError:
+            # corrupted or written by another version: build it again
+            f.close()
+            f = indexed_gzip.IndexedGzipFile(path)
+    f.build_full_index()
+    try:
+        f.export_index(idx_path)
+    except OSError:
+        pass
+    return f
 
-    temp = rescale(np.swapaxes(in_image, 0, 2), scale=((x_pix / x_final), (y_pix / y_final), (z_pix / z_final)),
-                   channel_axis=None, anti_aliasing=False, preserve_range=True)
-    logger.info('image downscaled')
 
-    temp = temp - nl
-    temp = temp.clip(min=0)
-    temp = np.power(temp, gamma)
-    if top == -1:
-        top = np.percentile(temp, mp)
-    temp = (temp / top) * 255
-    temp = temp.clip(max=255)
-    if reverse:
-        temp = np.flip(temp, 0)
-        temp = np.flip(temp, 2)
-    if flip:
-        temp = np.flip(temp, 1)
-    if expand:
-        temp = np.concatenate((temp, np.zeros((temp.shape[0], temp.shape[1], bs))), axis=2)
-
-    out_image = temp.astype('uint8')
-    logger.info('image processed')
-
-    nifti = nib.Nifti1Image(out_image, None)
-    nifti.header['pixdim'][1] = x_final
-    nifti.header['pixdim'][2] = y_final
-    nifti.header['pixdim'][3] = z_final
-    # 2 is the NIFTI code for unsigned char, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti.header['datatype'] = 2
-    nifti.header['bitpix'] = 8
-    # 2 is the NIFTI code for millimeters, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti.header['xyzt_units'] = 2
+def convertImage(in_path, out_path, reverse=False, expand=False, bs=100, x_final=0.025, y_final=0.025, z_final=0.025,
+                 x_pix=0.0104, y_pix=0.0104, z_pix=0.01, nl=110, gamma=0.3, mp=99.9, top=-1, flip=False, mask=None,
+                 slab=100, compute_dtype='float32'):
+    import os
 
     folder, file = os.path.split(in_path)
     if out_path == 'NULL':
         filename, ext = os.path.splitext(file)
         out_path = os.path.join(folder, filename + ".nii.gz")
 
-    nib.save(nifti, out_path)
-    logger.info('output image saved to %s', out_path)
-    return top
-
-
-def convertImage16(in_path, out_path, reverse=False, expand=False, bs=100, x_final=0.025, y_final=0.025, z_final=0.025,
-                   x_pix=0.0104, y_pix=0.0104, z_pix=0.01):
+    tops = convertImageMulti(in_path, [{'path': out_path, 'gamma': gamma, 'top': top}], reverse=reverse,
+                             expand=expand, bs=bs, x_final=x_final, y_final=y_final, z_final=z_final, x_pix=x_pix,
+                             y_pix=y_pix, z_pix=z_pix, nl=nl, mp=mp, flip=flip, mask=mask, slab=slab,
+                             compute_dtype=compute_dtype)
+    return tops[0]
+
+
+def convertImageMulti(in_path, outputs, reverse=False, expand=False, bs=100, x_final=0.025, y_final=0.025,
+                      z_final=0.025, x_pix=0.0104, y_pix=0.0104, z_pix=0.01, nl=110, mp=99.9, flip=False, mask=None,
+                      slab=100, stats_in=None, stats_out=None, compute_dtype='float32'):
+    # reads and downscales in_path once, then writes one image per element of outputs. Each output is a dict with
+    # 'path' and optionally 'type' ('uint8' or 'uint16'), 'gamma' and 'top' (only used for 8 bit outputs, with the
+    # same meaning as in convertImage). The histogram of the downscaled image is accumulated while the slabs are
+    # read and used for the percentile normalization. It is saved to stats_out if given; if stats_in is given, the
+    # histogram stored there (e.g. by the front side) is used instead. All the arithmetic is done in compute_dtype.
+    # mask is a (z, y, x) array multiplied with the input, or a function giving its planes lo:hi (see smoothed_mask).
+    # Returns the list of 'top' values used, None for 16 bit outputs
     import numpy as np
     import nibabel as nib
-    import os
     import logging
     from zetastitcher import InputFile
-    from skimage.transform import rescale
 
     logger = logging.getLogger(__name__)
     handle = InputFile(in_path)
-    in_image = handle.whole()
-    logger.info('input image loaded')
-
-    temp = rescale(np.swapaxes(in_image, 0, 2), scale=((x_pix / x_final), (y_pix / y_final), (z_pix / z_final)),
-                   channel_axis=None, anti_aliasing=False, preserve_range=True)
+    scale = ((x_pix / x_final), (y_pix / y_final), (z_pix / z_final))
+
+    if stats_in is not None:
+        hist = load_histogram(stats_in)
+        logger.info('intensity statistics loaded from %s', stats_in)
+    else:
+        hist = new_histogram()
+
+    # the input is read in slabs of z planes and downscaled straight into the output-resolution volume
+    down = np.zeros(_downscaled_shape(handle.shape, scale), dtype=compute_dtype)
+    for z0, z1, block in _downscale_slabs(handle, scale, mask=mask, slab=slab, compute_dtype=compute_dtype):
+        down[..., z0:z1] = block
+        if stats_in is None:
+            update_histogram(hist, block)
     logger.info('image downscaled')
 
-    if reverse:
-        temp = np.flip(temp, 0)
-        temp = np.flip(temp, 2)
-    if expand:
-        temp = np.concatenate((temp, np.zeros((temp.shape[0], temp.shape[1], bs))), axis=2)
-
-    out_image = temp.astype('uint16')
-    logger.info('image processed')
-
-    nifti = nib.Nifti1Image(out_image, None)
-    nifti.header['pixdim'][1] = x_final
-    nifti.header['pixdim'][2] = y_final
-    nifti.header['pixdim'][3] = z_final
-    # 512 is the NIFTI code for unsigned short, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti.header['datatype'] = 512
-    nifti.header['bitpix'] = 16
-    # 2 is the NIFTI code for millimeters, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti.header['xyzt_units'] = 2
+    if stats_out is not None:
+        save_histogram(hist, stats_out)
+        logger.info('intensity statistics saved to %s', stats_out)
+
+    tops = []
+    for output in outputs:
+        dtype = output.get('type', 'uint8')
+        if dtype == 'uint8':
+            gamma = output.get('gamma', 0.3)
+            top = output.get('top', -1)
+            if top == -1:
+                # the noise subtraction and the power law are monotonic, so the percentile of the mapped image
+                # is the mapped percentile of the downscaled image
+                top = np.power(np.maximum(histogram_percentile(hist, mp) - nl, 0), gamma)
+        else:
+            top = None
 
-    folder, file = os.path.split(in_path)
-    if out_path == 'NULL':
-        filename, ext = os.path.splitext(file)
-        out_path = os.path.join(folder, filename + "16bit.nii.gz")
+        shape = down.shape
+        if expand:
+            out_image = np.zeros((shape[0], shape[1], shape[2] + bs), dtype=dtype)
+        else:
+            out_image = np.zeros(shape, dtype=dtype)
+        # flips are applied through a view on the output, which is then filled slab by slab
+        dest = out_image[..., 0:shape[2]]
+        if reverse:
+            dest = np.flip(dest, 0)
+            dest = np.flip(dest, 2)
+        if flip:
+            dest = np.flip(dest, 1)
+        for z in range(0, shape[2], slab):
+            if dtype == 'uint8':
+                dest[..., z:(z + slab)] = _truncation_safe(_map8bit(np.copy(down[..., z:(z + slab)]), nl, gamma, top))
+            else:
+                dest[..., z:(z + slab)] = _truncation_safe(down[..., z:(z + slab)])
+        logger.info('image processed')
+
+        nifti = nib.Nifti1Image(out_image, None)
+        nifti.header['pixdim'][1] = x_final
+        nifti.header['pixdim'][2] = y_final
+        nifti.header['pixdim'][3] = z_final
+        if dtype == 'uint8':
+            # 2 is the NIFTI code for unsigned char, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
+            nifti.header['datatype'] = 2
+            nifti.header['bitpix'] = 8
+        else:
+            # 512 is the NIFTI code for unsigned short,
+            # see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
+            nifti.header['datatype'] = 512
+            nifti.header['bitpix'] = 16
+        # 2 is the NIFTI code for millimeters, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
+        nifti.header['xyzt_units'] = 2
 
-    nib.save(nifti, out_path)
-    logger.info('output image saved to %s', out_path)
+        save(nifti, output['path'])
+        logger.info('output image saved to %s', output['path'])
+        tops.append(top)
 
+    return tops
 
-def merge(f_path, b_path, out_path, ms, t):
-    import nibabel as nib
+
+def _map8bit(temp, nl, gamma, top):
+    # noise subtraction, gamma and normalization to 0-255, all in place on a floating point array
     import numpy as np
-    import logging
 
-    logger = logging.getLogger(__name__)
+    temp -= nl
+    temp.clip(min=0, out=temp)
+    np.power(temp, gamma, out=temp)
+    temp /= top
+    temp *= 255
+    temp.clip(max=255, out=temp)
+    return temp
 
-    front = nib.load(f_path)
-    f_data = front.get_fdata()
-    logger.info('front image loaded')
 
-    back = nib.load(b_path)
-    b_data = back.get_fdata()
-    logger.info('back image loaded')
+def _truncation_safe(temp):
+    # the integer outputs are truncated, as they always were. In float32 a value that should be an integer can come
+    # out just below it (0.5 * 100 + 0.5 * 100 gives 99.99999) and would lose one level, so it is first moved up by a
+    # few units of rounding error. float64 values are returned as they are and truncate exactly as before
+    import numpy as np
 
-    mid = int(float((front.header["dim"][3])) / 2) + ms
-    half = (int(float(t) / 2))
+    if temp.dtype == np.float64:
+        return temp
+    return temp + np.maximum(np.abs(temp), 1) * (4 * np.finfo(temp.dtype).eps)
 
-    out = np.zeros(f_data.shape).astype('uint8')
-    out[..., 0:(mid - half)] = f_data[..., 0:(mid - half)]
-    out[..., (mid + half):out.shape[2]] = b_data[..., (mid + half):out.shape[2]]
 
-    slab_front = np.zeros((out.shape[0], out.shape[1], 2 * half))
-    slab_front[...] = f_data[..., (mid - half):(mid + half)]
-    slab_back = np.zeros((out.shape[0], out.shape[1], 2 * half))
-    slab_back[...] = b_data[..., (mid - half):(mid + half)]
+def intensity_lut(nl, gamma, top):
+    # look-up table with the result of _map8bit for every 16 bit value (hence also for every 8 bit value): lut[image]
+    # maps a whole uint8/uint16 image with a single gather per voxel. The table itself is computed in float64. Only
+    # for images whose values are really integers: interpolated data must go through _map8bit, since the gamma curve
+    # is too steep above nl for the values to be rounded first
+    import numpy as np
 
-    for i in range(2 * half):
-        out[..., (mid - half) + i] = (slab_front[..., i] * (((2 * half - 1) - i) / (2 * half - 1))
-                                      + slab_back[..., i] * (i / (2 * half - 1))).astype('uint8')
+    return _map8bit(np.arange(2 ** 16, dtype='float'), nl, gamma, top).astype('uint8')
 
-    logger.info('images merged')
 
-    out_nifti = nib.Nifti1Image(out, None)
-    out_nifti.header['pixdim'] = front.header['pixdim']
-    out_nifti.header['xyzt_units'] = front.header['xyzt_units']
-    out_nifti.header['datatype'] = front.header['datatype']
-    out_nifti.header['bitpix'] = front.header['bitpix']
+def new_histogram(bins=2 ** 18, vmax=2 ** 16):
+    # intensity histogram used for streaming percentiles: counts in hist[0:bins] with bins of width
+    # vmax / bins (1/4 of a grey level with the defaults), the last element stores vmax
+    import numpy as np
 
-    nib.save(out_nifti, out_path)
-    logger.info('output image saved to %s', out_path)
+    hist = np.zeros(bins + 1)
+    hist[-1] = vmax
+    return hist
+
+
+def update_histogram(hist, data):
+    import numpy as np
+
+    bins = hist.shape[0] - 1
+    idx = data * (bins / hist[-1])
+    idx = np.clip(idx, 0, bins - 1).astype('int64')
+    hist[:-1] += np.bincount(idx.ravel(), minlength=bins)
+    return hist
+
+
+def histogram_percentile(hist, q):
+    # percentile q (0-100) of the data accumulated in hist, interpolating linearly inside the bin
+    import numpy as np
+
+    counts = hist[:-1]
+    width = hist[-1] / counts.shape[0]
+    cum = np.cumsum(counts)
+    target = cum[-1] * q / 100
+    i = int(np.searchsorted(cum, target))
+    i = min(i, counts.shape[0] - 1)
+    below = cum[i] - counts[i]
+    frac = (target - below) / counts[i] if counts[i] > 0 else 0
+    return (i + frac) * width
+
+
+def save_histogram(hist, path):
+    import numpy as np
+
+    with open(path, 'wb') as f:
+        np.save(f, hist)
+
+
+def load_histogram(path):
+    import numpy as np
+
+    return np.load(path)
+
+
+def _downscaled_shape(in_shape, scale):
+    # in_shape is (z, y, x) as returned by InputFile, the output shape is in NIfTI order (x, y, z)
+    import numpy as np
+
+    shape = (in_shape[2], in_shape[1], in_shape[0])
+    return tuple(int(np.maximum(np.round(n * s), 1)) for n, s in zip(shape, scale))
+
+
+def _downscale_slabs(handle, scale, mask=None, slab=100, compute_dtype='float32'):
+    # yields (z0, z1, block) where block holds output planes z0:z1 in NIfTI order (x, y, z). The result is the same
+    # as a linear, non anti-aliased skimage rescale of the whole stack, but only about `slab` input planes are
+    # kept in memory at a time: interpolation along z is done here, the xy part is left to skimage
+    import numpy as np
+    from skimage.transform import resize
+
+    nz = handle.shape[0]
+    out_shape = _downscaled_shape(handle.shape, scale)
+    zo = out_shape[2]
+
+    # source coordinates of the output planes, following the skimage/scipy 'grid' convention
+    c = (np.arange(zo) + 0.5) * (nz / zo) - 0.5
+    i0 = np.floor(c).astype(int)
+    w = (c - i0)[:, None, None].astype(compute_dtype)
+    i1 = np.clip(i0 + 1, 0, nz - 1)
+    i0 = np.clip(i0, 0, nz - 1)
+
+    step = int(np.maximum(1, np.floor(slab * zo / nz)))
+    for z0 in range(0, zo, step):
+        z1 = min(z0 + step, zo)
+        lo = i0[z0]
+        hi = i1[z1 - 1] + 1
+        block = handle[lo:hi]
+        if mask is not None:
+            block = block * (mask(lo, hi) if callable(mask) else mask[lo:hi])
+        block = block.astype(compute_dtype)
+        zs = (1 - w[z0:z1]) * block[i0[z0:z1] - lo] + w[z0:z1] * block[i1[z0:z1] - lo]
+        zs = resize(zs, (z1 - z0, out_shape[1], out_shape[0]), order=1, anti_aliasing=False, preserve_range=True)
+        yield z0, z1, np.swapaxes(zs, 0, 2)
+
+
+def smoothed_mask(in_path, sigma, level):
+    # mask of the voxels of in_path above level after a gaussian smoothing with sigma, as a function returning its
+    # planes lo:hi for _downscale_slabs. Each call reads the planes with a margin covering the gaussian kernel, so the
+    # result is the same as gaussian_filter on the whole stack, which is never in memory
+    import numpy as np
+    from scipy.ndimage import gaussian_filter
+    from zetastitcher import InputFile
+
+    handle = InputFile(in_path)
+    margin = int(4 * sigma + 0.5)
+
+    def planes(lo, hi):
+        a = max(lo - margin, 0)
+        b = min(hi + margin, handle.shape[0])
+        return gaussian_filter(np.asarray(handle[a:b]), sigma)[(lo - a):(hi - a)] > level
+
+    return planes
+
+
+def convertImage16(in_path, out_path, reverse=False, expand=False, bs=100, x_final=0.025, y_final=0.025, z_final=0.025,
+                   x_pix=0.0104, y_pix=0.0104, z_pix=0.01, slab=100, compute_dtype='float32'):
+    import os
+
+    folder, file = os.path.split(in_path)
+    if out_path == 'NULL':
+        filename, ext = os.path.splitext(file)
+        out_path = os.path.join(folder, filename + "16bit.nii.gz")
+
+    convertImageMulti(in_path, [{'path': out_path, 'type': 'uint16'}], reverse=reverse, expand=expand, bs=bs,
+                      x_final=x_final, y_final=y_final, z_final=z_final, x_pix=x_pix, y_pix=y_pix, z_pix=z_pix,
+                      slab=slab, compute_dtype=compute_dtype)
 
 
-def merge16(f_path, b_path, out_path, ms, t):
+def merge(f_path, b_path, out_path, ms, t, dtype=None, profile='linear', slab=100, compute_dtype='float32'):
+    # fuses front and back along z: below mid - t/2 the front is used, above mid + t/2 the back, and in between
+    # they are blended with weights given by profile. The output has the front data type unless dtype is given
     import nibabel as nib
     import numpy as np
     import logging
 
     logger = logging.getLogger(__name__)
 
-    front = nib.load(f_path)
-    f_data = front.get_fdata()
-    logger.info('front image loaded')
-
-    back = nib.load(b_path)
-    b_data = back.get_fdata()
-    logger.info('back image loaded')
+    front = load(f_path)
+    back = load(b_path)
+    if dtype is None:
+        dtype = front.get_data_dtype()
 
     mid = int(float((front.header["dim"][3])) / 2) + ms
     half = (int(float(t) / 2))
-
-    out = np.zeros(f_data.shape).astype('uint16')
-    out[..., 0:(mid - half)] = f_data[..., 0:(mid - half)]
-    out[..., (mid + half):out.shape[2]] = b_data[..., (mid + half):out.shape[2]]
-
-    slab_front = np.zeros((out.shape[0], out.shape[1], 2 * half))
-    slab_front[...] = f_data[..., (mid - half):(mid + half)]
-    slab_back = np.zeros((out.shape[0], out.shape[1], 2 * half))
-    slab_back[...] = b_data[..., (mid - half):(mid + half)]
-
-    for i in range(2 * half):
-        out[..., (mid - half) + i] = (slab_front[..., i] * (((2 * half - 1) - i) / (2 * half - 1))
-                                      + slab_back[..., i] * (i / (2 * half - 1))).astype('uint16')
+    shape = front.shape
+
+    # non-overlapping regions are copied slab by slab, without going through floating point. Each image is read in
+    # increasing z, front then transition then back, so gzip streams only move forward
+    out = np.empty(shape, dtype=dtype)
+    for z in range(0, mid - half, slab):
+        z1 = min(z + slab, mid - half)
+        out[..., z:z1] = front.dataobj[..., z:z1]
+    logger.info('front image copied')
+
+    # the transition region is blended in one broadcast operation
+    if half > 0:
+        w = feathering(2 * half, profile).astype(compute_dtype)
+        slab_front = np.array(front.dataobj[..., (mid - half):(mid + half)], dtype=compute_dtype)
+        slab_back = np.array(back.dataobj[..., (mid - half):(mid + half)], dtype=compute_dtype)
+        slab_front *= w[::-1]
+        slab_back *= w
+        slab_front += slab_back
+        out[..., (mid - half):(mid + half)] = _truncation_safe(slab_front)
+
+    for z in range(mid + half, shape[2], slab):
+        z1 = min(z + slab, shape[2])
+        out[..., z:z1] = back.dataobj[..., z:z1]
+    logger.info('back image copied')
 
     logger.info('images merged')
 
     out_nifti = nib.Nifti1Image(out, None)
     out_nifti.header['pixdim'] = front.header['pixdim']
     out_nifti.header['xyzt_units'] = front.header['xyzt_units']
-    out_nifti.header['datatype'] = front.header['datatype']
-    out_nifti.header['bitpix'] = front.header['bitpix']
+    out_nifti.header.set_data_dtype(dtype)
 
-    nib.save(out_nifti, out_path)
+    save(out_nifti, out_path)
     logger.info('output image saved to %s', out_path)
 
 
-def tif2nii(in_path, out_path, x_pix=0.025, y_pix=0.025, z_pix=0.025, type='uint8'):
+def merge16(f_path, b_path, out_path, ms, t, profile='linear', compute_dtype='float32'):
+    merge(f_path, b_path, out_path, ms, t, dtype='uint16', profile=profile, compute_dtype=compute_dtype)
+
+
+def feathering(n, profile='linear'):
+    # weights of the back image across a transition of n slices, going from 0 to 1. profile is 'linear', 'cosine',
+    # 'smoothstep' or a function mapping the normalized position (array from 0 to 1) to the weight. The front image
+    # gets the mirrored weights, so profiles should satisfy w(1 - u) = 1 - w(u)
+    import numpy as np
+
+    if n == 1:
+        u = np.ones(1)
+    else:
+        u = np.arange(n) / (n - 1)
+    if callable(profile):
+        w = profile(u)
+    elif profile == 'linear':
+        w = u
+    elif profile == 'cosine':
+        w = (1 - np.cos(np.pi * u)) / 2
+    elif profile == 'smoothstep':
+        w = u * u * (3 - 2 * u)
+    else:
+        raise ValueError('unknown feathering profile ' + str(profile))
+    return np.clip(np.asarray(w, dtype='float'), 0, 1)
+
+
+def tif2nii(in_path, out_path, x_pix=0.025, y_pix=0.025, z_pix=0.025, type='uint8', slab=100):
+    # the stack is memory-mapped when the TIFF is uncompressed, otherwise it is read in slabs; a (z, y, x) C-ordered
+    # slab has the same memory layout as the (x, y, z) Fortran-ordered NIfTI data, so no transposed copy is needed
     import numpy as np
     import nibabel as nib
     import os
     import logging
+    import tifffile as tiff
     from zetastitcher import InputFile
 
     logger = logging.getLogger(__name__)
-    handle = InputFile(in_path)
-    image = handle.whole()
-
-    logger.info('input image loaded')
-    out_image = np.swapaxes(image, 0, 2)
-    nifti = nib.Nifti1Image(out_image, None)
-    nifti.header['pixdim'][1] = x_pix
-    nifti.header['pixdim'][2] = y_pix
-    nifti.header['pixdim'][3] = z_pix
-    if type == 'uint8':
-        # 2 is the NIFTI code for unsigned char, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-        nifti.header['datatype'] = 2
-    elif type == 'uint16':
-        # 512 is the NIFTI code for unsigned 16bit, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-        nifti.header['datatype'] = 512
-
-    nifti.header['bitpix'] = 8
+    try:
+        stack = tiff.memmap(in_path, mode='r')
+        logger.info('input image memory-mapped')
+    except (ValueError, tiff.TiffFileError):
+        stack = InputFile(in_path)
+    shape = stack.shape
+
+    header = nib.Nifti1Header()
+    header.set_data_shape((shape[2], shape[1], shape[0]))
+    # sets the NIFTI datatype and bitpix codes, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
+    header.set_data_dtype(type)
+    header['pixdim'][1] = x_pix
+    header['pixdim'][2] = y_pix
+    header['pixdim'][3] = z_pix
     # 2 is the NIFTI code for millimeters, see https://nifti.nimh.nih.gov/nifti-1/documentation/nifti1fields/
-    nifti.header['xyzt_units'] = 2
+    header['xyzt_units'] = 2
+
+    def slabs():
+        for z in range(0, shape[0], slab):
+            yield np.swapaxes(np.asarray(stack[z:(z + slab)]), 0, 2)
 
     folder, file = os.path.split(in_path)
     if out_path == 'NULL':
         filename, ext = os.path.splitext(file)
         out_path = os.path.join(folder, filename + ".nii.gz")
 
-    nib.save(nifti, out_path)
+    save_slabs(header, slabs(), out_path)
     logger.info('output image saved to %s', out_path)
 
 
-def nii2tif(in_path, out_path):
-
+def nii2tif(in_path, out_path, type='uint8', slab=100, workers=None):
+    # the image is read in slabs (memory-mapped for .nii, through the gzip index for .nii.gz written by save) and
+    # written plane by plane; the zlib compression of the strips of each plane runs on workers threads
     import numpy as np
-    import nibabel as nib
     import os
     import logging
     import tifffile as tiff
 
     logger = logging.getLogger(__name__)
-    nifti = nib.load(in_path)
-    logger.info('input image loaded')
-    image = nifti.get_fdata()
-    image = np.swapaxes(image, 0, 1)
-    image = np.swapaxes(image, 0, 2)
-    image = np.swapaxes(image, 1, 2)
+    nifti = load(in_path)
+    shape = nifti.shape
+    logger.info('input image opened')
+
+    def planes():
+        for z in range(0, shape[2], slab):
+            block = np.asarray(nifti.dataobj[..., z:(z + slab)])
+            for i in range(block.shape[2]):
+                yield block[..., i].T.astype(type)
 
     folder, file = os.path.split(in_path)
     if out_path == 'NULL':
         filename, ext = os.path.splitext(file)
         out_path = os.path.join(folder, filename + ".tif")
 
-    tiff.imwrite(out_path, image.astype('uint8'), compression='zlib')
+    tiff.imwrite(out_path, planes(), shape=(shape[2], shape[1], shape[0]), dtype=type, compression='zlib',
+                 maxworkers=workers)
     logger.info('output image saved to %s', out_path)
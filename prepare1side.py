@@ -2,13 +2,11 @@
 
 
 def main():
-    from niftiutils import convertImage
+    from niftiutils import convertImageMulti, smoothed_mask
     import logging
     import coloredlogs
     import os
     import argparse
-    from zetastitcher import InputFile
-    from scipy.ndimage import gaussian_filter
 
     logger = logging.getLogger(__name__)
     logging.basicConfig(format='[%(funcName)s] - %(asctime)s - %(message)s', level=logging.INFO)
@@ -33,12 +31,11 @@ def main():
     parser.add_argument('-f', '--flip', help="vertically flip image", action='store_true', default=False)
     args = parser.parse_args()
 
+    rimage = None
     if args.red is not None:
+        # the mask is smoothed and thresholded slab by slab, while the yellow image is read
         logger.info('extracting mask from red image...')
-        red = InputFile(args.red)
-        rimage = red.whole()
-        rimage = gaussian_filter(rimage, args.sigma)
-        rimage = (rimage > args.noiselevel)
+        rimage = smoothed_mask(args.red, args.sigma, args.noiselevel)
 
     logger.info('processing yellow image...')
     # check if output folder exists
@@ -49,20 +46,11 @@ def main():
     path = os.path.join(args.output, name + ".nii.gz")
     path_nogamma = os.path.join(args.output, name + "_nogamma.nii.gz")
 
-    if args.red is None:
-        convertImage(args.yellow, out_path=path, x_final=args.x_final, y_final=args.y_final, z_final=args.z_final,
-                 x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noiselevel, gamma=args.gamma,
-                 mp=args.max_percentile, flip=args.flip)
-        convertImage(args.yellow, out_path=path_nogamma, x_final=args.x_final, y_final=args.y_final,
-                 z_final=args.z_final, x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix,
-                 nl=args.noiselevel, gamma=1, mp=args.max_percentile, flip=args.flip)
-    else:
-        convertImage(args.yellow, out_path=path, x_final=args.x_final, y_final=args.y_final, z_final=args.z_final,
-                     x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noiselevel, gamma=args.gamma,
-                     mp=args.max_percentile, flip=args.flip, mask=rimage)
-        convertImage(args.yellow, out_path=path_nogamma, x_final=args.x_final, y_final=args.y_final,
-                 z_final=args.z_final, x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix,
-                 nl=args.noiselevel, gamma=1, mp=args.max_percentile, flip=args.flip, mask=rimage)
+    # gamma and nogamma images are generated from a single read of the yellow image
+    convertImageMulti(args.yellow, [{'path': path, 'gamma': args.gamma}, {'path': path_nogamma, 'gamma': 1}],
+                      x_final=args.x_final, y_final=args.y_final, z_final=args.z_final, x_pix=args.x_pix,
+                      y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noiselevel, mp=args.max_percentile,
+                      flip=args.flip, mask=rimage)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ excess_border = 10
 
 
 def main():
-    from niftiutils import convertImage
+    from niftiutils import convertImageMulti
     import logging
     import coloredlogs
     import os
@@ -49,26 +49,24 @@ def main():
 
     fc_path = os.path.join(args.output, name + ".nii.gz")
     fc_path_nogamma = os.path.join(args.output, name + "_nogamma.nii.gz")
+    stats_path = os.path.join(args.output, name + "_stats.npy")
 
-    topg = convertImage(args.front, out_path=fc_path, expand=True, reverse=not args.reverse, bs=black,
-                        x_final=args.x_final, y_final=args.y_final, z_final=args.z_final, x_pix=args.x_pix,
-                        y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noise_level, gamma=args.gamma,
-                        mp=args.max_percentile)
-    topng = convertImage(args.front, out_path=fc_path_nogamma, expand=True, reverse=not args.reverse, bs=black,
-                         x_final=args.x_final, y_final=args.y_final, z_final=args.z_final, x_pix=args.x_pix,
-                         y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noise_level, gamma=1, mp=args.max_percentile)
+    # gamma and nogamma images are generated from a single read of the front image, whose intensity statistics
+    # are saved and reused for the normalization of the back image
+    convertImageMulti(args.front, [{'path': fc_path, 'gamma': args.gamma}, {'path': fc_path_nogamma, 'gamma': 1}],
+                      expand=True, reverse=not args.reverse, bs=black, x_final=args.x_final, y_final=args.y_final,
+                      z_final=args.z_final, x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix,
+                      nl=args.noise_level, mp=args.max_percentile, stats_out=stats_path)
 
     logger.info('processing back image...')
     base, back_file = os.path.split(args.back)
     name, ext = os.path.splitext(back_file)
     bc_path = os.path.join(args.output, name + ".nii.gz")
     bc_path_nogamma = os.path.join(args.output, name + "_nogamma.nii.gz")
-    convertImage(args.back, out_path=bc_path, x_final=args.x_final, y_final=args.y_final, z_final=args.z_final,
-                 x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noise_level, gamma=args.gamma,
-                 mp=args.max_percentile, top=topg, reverse=args.reverse)
-    convertImage(args.back, out_path=bc_path_nogamma, x_final=args.x_final, y_final=args.y_final, z_final=args.z_final,
-                 x_pix=args.x_pix, y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noise_level, gamma=1,
-                 mp=args.max_percentile, top=topng, reverse=args.reverse)
+    convertImageMulti(args.back, [{'path': bc_path, 'gamma': args.gamma}, {'path': bc_path_nogamma, 'gamma': 1}],
+                      x_final=args.x_final, y_final=args.y_final, z_final=args.z_final, x_pix=args.x_pix,
+                      y_pix=args.y_pix, z_pix=args.z_pix, nl=args.noise_level, mp=args.max_percentile,
+                      reverse=args.reverse, stats_in=stats_path)
 
     logger.info('writing initial transform file...')
     shift = len(front.pages)*args.z_pix-b2f_dist
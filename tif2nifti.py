@@ -20,7 +20,7 @@ def main():
     parser.add_argument('-t', '--type', default='uint8', help="data type")
     args = parser.parse_args()
 
-    tif2nii(args.input, args.output, args.x_pix, args.y_pix, args.z_pix)
+    tif2nii(args.input, args.output, args.x_pix, args.y_pix, args.z_pix, type=args.type)
 
 
 if __name__ == "__main__":
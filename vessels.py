@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+# approximate peak bytes per voxel of a block in block_vesselness (float64 derivatives, eigenvalues and their
+# temporaries), with some headroom
+_VOXEL_BYTES = 300
+
 
 def main():
     import logging
@@ -24,19 +28,23 @@ def main():
     parser.add_argument('-sxys', '--sigmaxystep', help="sigma step in xy", type=float, default=4)
     parser.add_argument('-szs', '--sigmazstep', help="sigma step in z", type=float, default=1)
     parser.add_argument('-s', '--skeleton', help='extract skeleton',  action='store_true', default=False)
+    parser.add_argument('-m', '--memory', help="memory budget in GB of the vesselness filter, which is then computed "
+                                               "in blocks (default: whole volume at once)", type=float)
 
     args = parser.parse_args()
 
     logger.info('loading input image...')
-    data = tiff.imread(args.input)
-    data = data.astype('float')
+    try:
+        data = tiff.memmap(args.input, mode='r')
+    except ValueError:
+        data = tiff.imread(args.input)
 
     sigmaxy = np.arange(args.sigmaxymin, args.sigmaxymax, args.sigmaxystep)
     sigmaz = np.arange(args.sigmazmin, args.sigmazmax, args.sigmazstep)
     sigmas = np.stack((sigmaz, sigmaxy, sigmaxy), axis=1)
 
     logger.info('computing vesselness...')
-    temp = vesselness(data, sigmas)
+    temp = vesselness(data, sigmas, None if args.memory is None else args.memory * 1024 ** 3)
 
     logger.info('smoothing and thresholding vesselness image...')
     temp = gaussian(temp, sigma=2)
@@ -52,8 +60,60 @@ def main():
         tiff.imwrite(args.output, (temp * 255).astype('uint8'))
 
 
-def vesselness(data, sigmas):
-    from scipy.ndimage import gaussian_filter1d
+def vesselness(data, sigmas, memory=None, out=None):
+    # vesselness of data, the maximum over sigmas of the response at each scale. With memory (in bytes) the volume is
+    # processed in overlapping blocks, see vesselness_tiles, and the result is written into out (e.g. a memory map)
+    # if given
+    import numpy as np
+
+    if out is None:
+        out = np.zeros(data.shape)
+    for block, v in vesselness_tiles(data, sigmas, memory):
+        out[block] = v
+
+    return out
+
+
+def vesselness_tiles(data, sigmas, memory=None):
+    # yields (slices, vesselness) for blocks covering data. Each block is filtered with a halo of 4 sigma (the extent
+    # of the gaussian kernels) that is then cropped, so the blocks are exactly the corresponding parts of the
+    # vesselness of the whole volume. The blocks fit in memory (in bytes, None for a single block, see _block_side),
+    # which raises ValueError if it is too small for the halo. data is read and converted to float one block at a
+    # time, so it can be a memory map
+    import numpy as np
+    import logging
+    import coloredlogs
+
+    logger = logging.getLogger(__name__)
+    logging.basicConfig(format='[%(funcName)s] - %(asctime)s - %(message)s', level=logging.INFO)
+    coloredlogs.install(level='DEBUG', logger=logger)
+
+    halo = [int(4 * s + 0.5) for s in np.max(sigmas, axis=0)]
+    side = _block_side(data.shape, halo, memory)
+    count = int(np.prod([-(-m // n) for m, n in zip(data.shape, side)]))
+
+    # the contrast normalization of each sigma depends on the maximum of s over the whole volume, with more than
+    # one block it needs a first pass
+    cs = None
+    if count > 1:
+        smax = np.zeros(len(sigmas))
+        for n, (extended, inner, block) in enumerate(_blocks(data.shape, halo, side)):
+            logger.info('computing normalization in block %d of %d', n + 1, count)
+            tile = np.asarray(data[extended]).astype('float')
+            for k, row in enumerate(sigmas):
+                s = hessian_ratios(tile, row)[-1]
+                smax[k] = max(smax[k], np.max(s[inner]))
+        cs = 0.5 * smax
+
+    for n, (extended, inner, block) in enumerate(_blocks(data.shape, halo, side)):
+        if count > 1:
+            logger.info('computing vesselness in block %d of %d', n + 1, count)
+        tile = np.asarray(data[extended]).astype('float')
+        yield block, block_vesselness(tile, sigmas, cs)[inner]
+
+
+def block_vesselness(data, sigmas, cs=None):
+    # vesselness of data, with contrast normalization c of each sigma from cs, or half the maximum s in data
     import numpy as np
     import logging
     import coloredlogs
@@ -64,28 +124,12 @@ def vesselness(data, sigmas):
     i = 1
 
     for row in sigmas:
-        logger.info('computing filtering with sigma #%d of %d', i, len(sigmas))
-        h11 = gaussian_filter1d(data, row[0], axis=0, order=2)
-        h22 = gaussian_filter1d(data, row[1], axis=1, order=2)
-        h33 = gaussian_filter1d(data, row[2], axis=2, order=2)
-        h1 = gaussian_filter1d(data, row[0], axis=0, order=1)
-        h2 = gaussian_filter1d(data, row[0], axis=0, order=1)
-        h12 = gaussian_filter1d(h1, row[1], axis=1, order=1)
-        h13 = gaussian_filter1d(h1, row[2], axis=2, order=1)
-        h23 = gaussian_filter1d(h2, row[2], axis=2, order=1)
-
-        eigv1, eigv2, eigv3 = eigenvalues(h11, h22, h33, h12, h13, h23)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ra = np.abs(eigv2) / np.abs(eigv3)
-            rb = np.abs(eigv1) / np.sqrt(np.abs(eigv2 * eigv3))
-            s = np.sqrt(eigv1 ** 2 + eigv2 ** 2 + eigv3 ** 2)
-        ra = np.nan_to_num(ra)
-        rb = np.nan_to_num(rb)
-        s = np.nan_to_num(s)
+        logger.debug('computing filtering with sigma #%d of %d', i, len(sigmas))
+        eigv2, eigv3, ra, rb, s = hessian_ratios(data, row)
 
         alfa = 0.5
         beta = 0.5
-        c = 0.5 * np.max(s)
+        c = 0.5 * np.max(s) if cs is None else cs[i - 1]
 
         temp = np.where(np.logical_or((eigv2 > 0), (eigv3 > 0)), 0,
                      (1 - np.exp(-(ra ** 2) / (2 * alfa ** 2))) * np.exp(-(rb ** 2) / (2 * beta ** 2)) * (
@@ -101,6 +145,77 @@ def vesselness(data, sigmas):
     return(v)
 
 
+def hessian_ratios(data, row):
+    # eigenvalues 2 and 3 of the hessian of data at scale row (sigma in z, y, x), the ratios ra and rb and the
+    # structure norm s of the vesselness
+    from scipy.ndimage import gaussian_filter1d
+    import numpy as np
+
+    h11 = gaussian_filter1d(data, row[0], axis=0, order=2)
+    h22 = gaussian_filter1d(data, row[1], axis=1, order=2)
+    h33 = gaussian_filter1d(data, row[2], axis=2, order=2)
+    h1 = gaussian_filter1d(data, row[0], axis=0, order=1)
+    h2 = gaussian_filter1d(data, row[0], axis=0, order=1)
+    h12 = gaussian_filter1d(h1, row[1], axis=1, order=1)
+    h13 = gaussian_filter1d(h1, row[2], axis=2, order=1)
+    h23 = gaussian_filter1d(h2, row[2], axis=2, order=1)
+    del h1, h2
+
+    eigv1, eigv2, eigv3 = eigenvalues(h11, h22, h33, h12, h13, h23)
+    del h11, h22, h33, h12, h13, h23
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ra = np.abs(eigv2) / np.abs(eigv3)
+        rb = np.abs(eigv1) / np.sqrt(np.abs(eigv2 * eigv3))
+        s = np.sqrt(eigv1 ** 2 + eigv2 ** 2 + eigv3 ** 2)
+    ra = np.nan_to_num(ra)
+    rb = np.nan_to_num(rb)
+    s = np.nan_to_num(s)
+
+    return eigv2, eigv3, ra, rb, s
+
+
+def _block_side(shape, halo, memory=None):
+    # block sides for a volume of shape, chosen to filter the least volume (blocks plus halos) among the splits in
+    # equal blocks whose blocks extended by halo fit in memory bytes (the whole volume if memory is None)
+    import numpy as np
+
+    if memory is None:
+        return list(shape)
+
+    # for each axis, the distinct block sides, the largest extended block and the extended length of all blocks
+    sides = []
+    largest = []
+    total = []
+    for m, h in zip(shape, halo):
+        n = np.unique(-(-m // np.arange(1, m + 1)))
+        sides.append(n)
+        largest.append(np.minimum(n + 2 * h, m))
+        total.append(np.array([np.sum(np.minimum(np.arange(k, m, k) + h, m))
+                               - np.sum(np.maximum(np.arange(0, m, k) - h, 0)) + m for k in n]))
+    size = np.prod(np.meshgrid(*largest, indexing='ij'), axis=0)
+    work = np.prod(np.meshgrid(*total, indexing='ij'), axis=0).astype('float')
+    work[size * _VOXEL_BYTES > memory] = np.inf
+    if not np.isfinite(work).any():
+        raise ValueError('a memory budget of %d bytes is too small for the halo of %s voxels, at least %d bytes '
+                         'are needed' % (memory, tuple(halo), np.min(size) * _VOXEL_BYTES))
+    best = np.unravel_index(np.argmin(work), work.shape)
+    return [int(n[i]) for n, i in zip(sides, best)]
+
+
+def _blocks(shape, halo, side):
+    # yields the blocks of side covering a volume of shape, as (slices of the block extended by halo, slices of the
+    # block in the extended one, slices of the block), the extended blocks being clipped to the volume
+    import itertools
+
+    for start in itertools.product(*(range(0, m, n) for m, n in zip(shape, side))):
+        stop = [min(a + n, m) for a, n, m in zip(start, side, shape)]
+        lo = [max(a - h, 0) for a, h in zip(start, halo)]
+        hi = [min(b + h, m) for b, h, m in zip(stop, halo, shape)]
+        yield (tuple(slice(a, b) for a, b in zip(lo, hi)),
+               tuple(slice(a - c, b - c) for a, b, c in zip(start, stop, lo)),
+               tuple(slice(a, b) for a, b in zip(start, stop)))
+
+
 def eigenvalues(a11, a22, a33, a12, a13, a23):
     import numpy as np
 